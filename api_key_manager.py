@@ -6,7 +6,11 @@ switches to backup keys when one fails due to rate limiting or errors.
 """
 
 import os
+import re
 import time
+import random
+import requests
+from requests.adapters import HTTPAdapter
 from typing import List, Dict, Optional, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
@@ -263,3 +267,63 @@ def get_api_key_manager() -> APIKeyManager:
     if _api_key_manager is None:
         _api_key_manager = APIKeyManager()
     return _api_key_manager
+
+
+class RateLimiter:
+    """Thread-safe minimum-interval limiter that paces callers to `rps` requests per second."""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the caller's request slot comes up."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Shared HTTP session so NIM/Gemini/OpenRouter calls reuse keep-alive connections
+# instead of paying a TLS handshake per request. Retries are handled by post_with_retry.
+_http_session = requests.Session()
+_http_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+
+# HTTP statuses and error text that indicate a transient failure worth retrying
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+_RATE_LIMIT_RE = re.compile(r'rate limit|quota', re.IGNORECASE)
+
+
+def _is_retryable_response(response: requests.Response) -> bool:
+    """Check whether a response looks like throttling or a transient server error."""
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        return True
+    return not response.ok and bool(_RATE_LIMIT_RE.search(response.text or ''))
+
+
+def post_with_retry(url: str, max_attempts: int = 3, base: float = 1.0, cap: float = 16.0, **kwargs) -> requests.Response:
+    """
+    POST with exponential backoff and full jitter on transient failures.
+
+    Retries on 429/5xx responses, rate-limit/quota error bodies, connection
+    errors and timeouts. The last response is returned (or the last exception
+    re-raised) so callers keep their usual raise_for_status() handling.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = _http_session.post(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == max_attempts:
+                raise
+            logger.warning(f"POST to {url.split('?')[0]} failed ({e!r}), attempt {attempt}/{max_attempts}")
+        else:
+            if attempt == max_attempts or not _is_retryable_response(response):
+                return response
+            logger.warning(f"POST to {url.split('?')[0]} returned {response.status_code}, attempt {attempt}/{max_attempts}")
+
+        time.sleep(random.uniform(0, min(cap, base * 2 ** (attempt - 1))))
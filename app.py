@@ -57,6 +57,10 @@ def create_app():
     with app.app_context():
         setup_database()
 
+    # Warm the font cache used by PDF generation
+    from utils import preload_fonts
+    preload_fonts()
+
     # Setup Login Manager
     from user_auth import setup_login_manager
     setup_login_manager(app)
@@ -1,78 +1,87 @@
 import sqlite3
 import json
 import os
-import shutil
 import zipfile
 
-def backup_database_and_files(db_path='instance/database.db', backup_dir='backup', zip_filename='backup.zip'):
+# Formats that are already compressed; deflating them again costs CPU for ~no size gain
+ALREADY_COMPRESSED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.pdf', '.zip'}
+
+def _compress_type_for(filename):
+    """Returns ZIP_STORED for already-compressed files and ZIP_DEFLATED for everything else."""
+    if os.path.splitext(filename)[1].lower() in ALREADY_COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def _write_json_array(stream, items):
+    """Writes items to a binary stream as a JSON array, one element at a time."""
+    stream.write(b'[')
+    for index, item in enumerate(items):
+        if index:
+            stream.write(b',')
+        stream.write(b'\n')
+        stream.write(json.dumps(item).encode('utf-8'))
+    stream.write(b'\n]')
+
+def backup_database_and_files(db_path='instance/database.db', zip_filename='backup.zip'):
     """
     Exports all tables from the SQLite database to JSON files, backs up associated files,
-    and creates a zip archive of the backup.
+    and writes both straight into a zip archive without staging a copy on disk.
 
     :param db_path: Path to the SQLite database file.
-    :param backup_dir: Directory to save the backup.
     :param zip_filename: Name of the output zip file.
     """
-    if os.path.exists(backup_dir):
-        shutil.rmtree(backup_dir)
-    os.makedirs(backup_dir)
+    print(f"Creating zip archive: {zip_filename}")
+    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        # 1. Backup the database to JSON files
+        conn, db_error = None, None
+        try:
+            conn = sqlite3.connect(db_path)
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
 
-    # 1. Backup the database to JSON files
-    try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+            tables = [row[0] for row in cursor.fetchall()]
 
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = [row[0] for row in cursor.fetchall()]
+            for table_name in tables:
+                print(f"Backing up table: {table_name}")
+                cursor.execute(f"SELECT * FROM {table_name}")
+                
+                arcname = f"{table_name}.json"
+                with zipf.open(arcname, 'w') as entry:
+                    _write_json_array(entry, (dict(row) for row in cursor))
+                
+                print(f"Successfully backed up {table_name} to {arcname}")
 
-        for table_name in tables:
-            print(f"Backing up table: {table_name}")
-            cursor.execute(f"SELECT * FROM {table_name}")
-            rows = cursor.fetchall()
-            data = [dict(row) for row in rows]
-            
-            backup_file_path = os.path.join(backup_dir, f"{table_name}.json")
-            with open(backup_file_path, 'w') as f:
-                json.dump(data, f, indent=4)
-            
-            print(f"Successfully backed up {table_name} to {backup_file_path}")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            db_error = e
+        finally:
+            if conn:
+                conn.close()
 
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        # 2. Backup associated files, read once from their source directories
+        file_dirs_to_backup = [] if db_error else ['output', 'processed', 'uploads']
+        for dir_name in file_dirs_to_backup:
+            source_dir = dir_name
+            
+            if os.path.exists(source_dir):
+                print(f"Backing up directory: {source_dir}")
+                for root, dirs, files in os.walk(source_dir):
+                    for file in files:
+                        file_path = os.path.join(root, file)
+                        arcname = os.path.join(dir_name, os.path.relpath(file_path, source_dir))
+                        zipf.write(file_path, arcname, compress_type=_compress_type_for(file))
+                print(f"Successfully backed up {source_dir}")
+            else:
+                print(f"Directory not found, skipping: {source_dir}")
+    
+    if db_error:
+        # Don't leave a backup behind that is missing its tables
+        os.remove(zip_filename)
         return
-    finally:
-        if conn:
-            conn.close()
-
-    # 2. Backup associated files
-    file_dirs_to_backup = ['output', 'processed', 'uploads']
-    for dir_name in file_dirs_to_backup:
-        source_dir = dir_name
-        dest_dir = os.path.join(backup_dir, dir_name)
-        
-        if os.path.exists(source_dir):
-            print(f"Backing up directory: {source_dir}")
-            shutil.copytree(source_dir, dest_dir)
-            print(f"Successfully backed up {source_dir} to {dest_dir}")
-        else:
-            print(f"Directory not found, skipping: {source_dir}")
 
-    # 3. Create a zip archive of the backup directory
-    print(f"\nCreating zip archive: {zip_filename}")
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(backup_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, backup_dir)
-                zipf.write(file_path, arcname)
-    
     print(f"Successfully created {zip_filename}")
 
-    # 4. Clean up the backup directory
-    shutil.rmtree(backup_dir)
-    print(f"Cleaned up backup directory: {backup_dir}")
-
     print("\nBackup complete!")
 
 if __name__ == '__main__':
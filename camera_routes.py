@@ -56,40 +56,57 @@ def handle_remote_capture(data):
 @camera_bp.route('/camera/upload_captured_image', methods=['POST'])
 @login_required
 def upload_captured_image():
-    if 'image' not in request.files:
+    # Accept a batch of frames under 'images' as well as the single 'image' field
+    files = request.files.getlist('images') or request.files.getlist('image')
+    if not files:
         return jsonify({'error': 'No image file provided'}), 400
     
-    file = request.files['image']
-    if file.filename == '':
+    files = [file for file in files if file and file.filename != '']
+    if not files:
         return jsonify({'error': 'No selected file'}), 400
 
-    if file:
-        session_id = str(uuid.uuid4())
-        original_filename = secure_filename(file.filename) or f"captured_image_{session_id}.png"
-        
-        # Save to UPLOAD_FOLDER or TEMP_FOLDER
-        # For captured images, TEMP_FOLDER is suitable, then processed further
-        save_path = os.path.join(os.getcwd(), 'tmp', original_filename) # Using tmp folder relative to CWD
+    session_id = str(uuid.uuid4())
+    
+    # Save to UPLOAD_FOLDER or TEMP_FOLDER
+    # For captured images, TEMP_FOLDER is suitable, then processed further
+    image_rows = []
+    saved_paths = []
+    for i, file in enumerate(files):
+        original_filename = secure_filename(file.filename) or 'capture.png'
+        # Frames are often posted under the same name ("blob", "capture.png"), so the stored
+        # name is made unique per frame and the client's name is only kept as original_name
+        filename = f"{session_id}_{i}_{original_filename}"
+        save_path = os.path.join(os.getcwd(), 'tmp', filename) # Using tmp folder relative to CWD
         file.save(save_path)
+        saved_paths.append(save_path)
+        image_rows.append((session_id, i, filename, original_filename, 'original'))
 
-        conn = get_db_connection()
-        try:
-            conn.execute(
-                'INSERT INTO sessions (id, original_filename, name, user_id, session_type) VALUES (?, ?, ?, ?, ?)',
-                (session_id, original_filename, original_filename, current_user.id, 'image_capture')
-            )
-            # Insert the image into the images table
-            conn.execute(
-                'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
-                (session_id, 0, original_filename, original_filename, 'original')
-            )
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            return jsonify({'error': f'Database error: {str(e)}'}), 500
-        finally:
-            conn.close()
-            
-        return jsonify({'success': True, 'session_id': session_id, 'filename': original_filename})
-    
-    return jsonify({'error': 'Image capture failed'}), 500
+    session_filename = image_rows[0][3] if len(image_rows) == 1 else f"{len(image_rows)} captured images"
+
+    conn = get_db_connection()
+    try:
+        # One write transaction for the session and all of its images
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT INTO sessions (id, original_filename, name, user_id, session_type) VALUES (?, ?, ?, ?, ?)',
+            (session_id, session_filename, session_filename, current_user.id, 'image_capture')
+        )
+        # Insert the images into the images table
+        conn.executemany(
+            'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
+            image_rows
+        )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        # Nothing references the frames once the inserts are rolled back
+        for save_path in saved_paths:
+            try:
+                os.remove(save_path)
+            except OSError:
+                pass
+        return jsonify({'error': f'Database error: {str(e)}'}), 500
+    finally:
+        conn.close()
+        
+    return jsonify({'success': True, 'session_id': session_id, 'filename': image_rows[0][2], 'filenames': [row[2] for row in image_rows]})
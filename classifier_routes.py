@@ -1,53 +1,142 @@
 from flask import Blueprint, jsonify, current_app, render_template, request
 from flask_login import login_required, current_user
 from utils import get_db_connection
+from database import (create_classification_job, set_classification_job, fetch_classification_job, fetch_ocr_cache, store_ocr_cache,
+                      fetch_suggestions_version, bump_suggestions_version)
 import os
 import time
 import json
-from processing import resize_image_if_needed, call_nim_ocr_api
+import logging
+import contextlib
+import hashlib
+import threading
+import uuid
+import itertools
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from processing import resize_image_if_needed, call_nim_ocr_api_batch, NIM_MAX_CONCURRENCY, NIM_BATCH_SIZE
+from api_key_manager import RateLimiter
 from gemini_classifier import classify_questions_with_gemini
 from nova_classifier import classify_questions_with_nova
 
 classifier_bp = Blueprint('classifier_bp', __name__)
 
+# Upper bound on classifier batches in flight per extract-and-classify run
+CLASSIFIER_MAX_WORKERS = int(os.getenv('CLASSIFIER_MAX_WORKERS', 4))
+# Optional pacing for classifier batches; 0 disables it and throttling is left to post_with_retry's backoff
+_classifier_rate_limiter = RateLimiter(float(os.getenv('CLASSIFIER_RPS', 0)))
+
+# Field accessors for NIM OCR text detections
+_get_text_prediction = itemgetter('text_prediction')
+_get_text = itemgetter('text')
+
+# Chapter/tag suggestions for the edit page: user_id -> (suggestions_version, expires_at, chapters, tags).
+# An entry is only served while its version matches user_meta, which the classifier writes below bump in
+# their own transaction, so every worker sees an edit immediately. The TTL bounds staleness from
+# question edits made outside this blueprint, which don't bump the version.
+SUGGESTION_CACHE_TTL = 300
+# Questions shown per page on the edit page
+CLASSIFIED_PAGE_SIZE = 100
+_suggestion_cache = {}
+
+def _apply_classification_updates(conn, updates):
+    """Writes a batch of {image_id: (subject, chapter)} results with a single CASE-based UPDATE."""
+    if not updates:
+        return
+    subject_params, chapter_params = [], []
+    for image_id, (subject, chapter) in updates.items():
+        subject_params += (image_id, subject)
+        chapter_params += (image_id, chapter)
+    whens = ' '.join('WHEN ? THEN ?' for _ in updates)
+    placeholders = ','.join('?' for _ in updates)
+    conn.execute(
+        f'UPDATE questions SET subject = CASE image_id {whens} END, chapter = CASE image_id {whens} END '
+        f'WHERE image_id IN ({placeholders})',
+        (*subject_params, *chapter_params, *updates)
+    )
+
 @classifier_bp.route('/classified/edit')
 @login_required
 def edit_classified_questions():
     """Renders the page for editing classified questions."""
-    conn = get_db_connection()
-
     AVAILABLE_SUBJECTS = ["Biology", "Chemistry", "Physics", "Mathematics"]
-    
-    # Security: Fetch questions belonging to the current user
-    questions_from_db = conn.execute("""
-        SELECT q.id, q.question_text, q.chapter, q.subject, q.tags 
-        FROM questions q
-        JOIN sessions s ON q.session_id = s.id
-        WHERE s.user_id = ? AND q.subject IS NOT NULL AND q.chapter IS NOT NULL 
-        ORDER BY q.id
-    """, (current_user.id,)).fetchall()
-    
-    questions = []
-    for q in questions_from_db:
-        q_dict = dict(q)
-        plain_text = q_dict['question_text'] # It's already plain text from OCR
-        q_dict['question_text_plain'] = (plain_text[:100] + '...') if len(plain_text) > 100 else plain_text
-        questions.append(q_dict)
-
-    # Suggestions should also be user-specific
-    chapters = conn.execute('SELECT DISTINCT q.chapter FROM questions q JOIN sessions s ON q.session_id = s.id WHERE s.user_id = ? AND q.chapter IS NOT NULL ORDER BY q.chapter', (current_user.id,)).fetchall()
-    tags_query = conn.execute('SELECT DISTINCT q.tags FROM questions q JOIN sessions s ON q.session_id = s.id WHERE s.user_id = ? AND q.tags IS NOT NULL AND q.tags != \'\'', (current_user.id,)).fetchall()
-    all_tags = set()
-    for row in tags_query:
-        tags = [tag.strip() for tag in row['tags'].split(',')]
-        all_tags.update(tags)
-
-    conn.close()
+    after_id = request.args.get('after', 0, type=int)
+
+    with contextlib.closing(get_db_connection()) as conn, conn:
+        # Security: Questions and suggestions are all scoped to the current user.
+        # They come back as one result set tagged by `kind` to save two extra queries;
+        # the suggestion part is skipped while the user's cached lists are still current.
+        query = """
+            WITH RECURSIVE user_questions AS (
+                SELECT q.id, q.question_text, q.chapter, q.subject, q.tags
+                FROM questions q
+                JOIN sessions s ON q.session_id = s.id
+                WHERE s.user_id = ?
+            ),
+            split(tag, rest) AS (
+                SELECT '', tags || ',' FROM user_questions WHERE tags IS NOT NULL AND tags != ''
+                UNION ALL
+                SELECT trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1)
+                FROM split WHERE rest != ''
+            )
+            SELECT * FROM (
+                SELECT 'question' AS kind, id AS sort_key, id,
+                       CASE WHEN length(substr(question_text, 1, 101)) > 100
+                            THEN substr(question_text, 1, 100) || '...'
+                            ELSE question_text END AS question_text_plain,
+                       chapter, subject, tags
+                FROM user_questions WHERE subject IS NOT NULL AND chapter IS NOT NULL AND id > ?
+                ORDER BY id LIMIT ?
+            )
+        """
+        # Read before the suggestions are computed: a write landing in between bumps the version
+        # past the one they are stored under, so the next request recomputes rather than serving stale lists
+        version = fetch_suggestions_version(conn, current_user.id)
+        cached = _suggestion_cache.get(current_user.id)
+        if cached is None or cached[0] != version or cached[1] < time.monotonic():
+            cached = None
+            query += """
+            UNION ALL
+            SELECT DISTINCT 'chapter', chapter, NULL, NULL, chapter, NULL, NULL
+            FROM user_questions WHERE chapter IS NOT NULL
+            UNION ALL
+            SELECT DISTINCT 'tag', tag, NULL, NULL, NULL, NULL, tag
+            FROM split WHERE tag != ''
+            """
+        # Keyset pagination: one row past the page is fetched to tell whether there is a next page
+        rows = conn.execute(query + " ORDER BY kind, sort_key", (current_user.id, after_id, CLASSIFIED_PAGE_SIZE + 1))
+
+        questions = []
+        chapters = []
+        all_tags = []
+        # Iterate the cursor directly so rows are consumed as SQLite produces them
+        for row in rows:
+            kind = row['kind']
+            if kind == 'question':
+                # The preview text is already truncated (with its ellipsis) by SQLite
+                questions.append({key: row[key] for key in ('id', 'question_text_plain', 'chapter', 'subject', 'tags')})
+            elif kind == 'chapter':
+                chapters.append(row['chapter'])
+            else:
+                all_tags.append(row['tags'])
+
+        if cached is None:
+            _suggestion_cache[current_user.id] = (version, time.monotonic() + SUGGESTION_CACHE_TTL, chapters, all_tags)
+        else:
+            _, _, chapters, all_tags = cached
+
+    next_after = None
+    if len(questions) > CLASSIFIED_PAGE_SIZE:
+        del questions[CLASSIFIED_PAGE_SIZE:]
+        next_after = questions[-1]['id']
+
     return render_template('classified_edit.html', 
                            questions=questions, 
-                           chapters=[c['chapter'] for c in chapters], 
-                           all_tags=sorted(list(all_tags)),
-                           available_subjects=AVAILABLE_SUBJECTS)
+                           chapters=chapters, 
+                           all_tags=all_tags,
+                           available_subjects=AVAILABLE_SUBJECTS,
+                           after_id=after_id,
+                           next_after=next_after)
 
 @classifier_bp.route('/classified/update_question/<int:question_id>', methods=['POST'])
 @login_required
@@ -61,19 +150,17 @@ def update_classified_question(question_id):
         return jsonify({'error': 'Chapter and Subject cannot be empty.'}), 400
 
     try:
-        conn = get_db_connection()
-        # Security: Check ownership before update
-        question_owner = conn.execute("SELECT s.user_id FROM questions q JOIN sessions s ON q.session_id = s.id WHERE q.id = ?", (question_id,)).fetchone()
-        if not question_owner or question_owner['user_id'] != current_user.id:
-            conn.close()
+        with contextlib.closing(get_db_connection()) as conn, conn:
+            # Security: The ownership check is part of the UPDATE, so a missing or foreign question matches no rows
+            cursor = conn.execute(
+                'UPDATE questions SET chapter = ?, subject = ? WHERE id = ? AND session_id IN (SELECT id FROM sessions WHERE user_id = ?)',
+                (new_chapter, new_subject, question_id, current_user.id)
+            )
+            if cursor.rowcount:
+                bump_suggestions_version(conn, current_user.id)
+        if cursor.rowcount == 0:
             return jsonify({'error': 'Unauthorized'}), 403
 
-        conn.execute(
-            'UPDATE questions SET chapter = ?, subject = ? WHERE id = ?',
-            (new_chapter, new_subject, question_id)
-        )
-        conn.commit()
-        conn.close()
         return jsonify({'success': True})
     except Exception as e:
         current_app.logger.error(f"Error updating question {question_id}: {repr(e)}")
@@ -84,18 +171,18 @@ def update_classified_question(question_id):
 def delete_classified_question(question_id):
     """Handles deleting a classified question."""
     try:
-        conn = get_db_connection()
-        # Security: Check ownership before delete
-        question_owner = conn.execute("SELECT s.user_id FROM questions q JOIN sessions s ON q.session_id = s.id WHERE q.id = ?", (question_id,)).fetchone()
-        if not question_owner or question_owner['user_id'] != current_user.id:
-            conn.close()
+        with contextlib.closing(get_db_connection()) as conn, conn:
+            # Update the question to remove classification
+            # Security: The ownership check is part of the UPDATE, so a missing or foreign question matches no rows
+            cursor = conn.execute(
+                'UPDATE questions SET subject = NULL, chapter = NULL WHERE id = ? AND session_id IN (SELECT id FROM sessions WHERE user_id = ?)',
+                (question_id, current_user.id)
+            )
+            if cursor.rowcount:
+                bump_suggestions_version(conn, current_user.id)
+        if cursor.rowcount == 0:
             return jsonify({'error': 'Unauthorized'}), 403
 
-        # Update the question to remove classification
-        conn.execute('UPDATE questions SET subject = NULL, chapter = NULL WHERE id = ?', (question_id,))
-        
-        conn.commit()
-        conn.close()
         return jsonify({'success': True})
     except Exception as e:
         current_app.logger.error(f"Error deleting question {question_id}: {repr(e)}")
@@ -112,26 +199,18 @@ def delete_many_classified_questions():
         return jsonify({'error': 'No question IDs provided.'}), 400
 
     try:
-        conn = get_db_connection()
-        # Security: Filter IDs to only those owned by the user
-        placeholders = ','.join('?' for _ in question_ids)
-        owned_q_ids_rows = conn.execute(f"""
-            SELECT q.id FROM questions q
-            JOIN sessions s ON q.session_id = s.id
-            WHERE q.id IN ({placeholders}) AND s.user_id = ?
-        """, (*question_ids, current_user.id)).fetchall()
-        
-        owned_q_ids = [row['id'] for row in owned_q_ids_rows]
-
-        if not owned_q_ids:
-            conn.close()
+        with contextlib.closing(get_db_connection()) as conn, conn:
+            # Security: Only questions in the user's own sessions are matched by the UPDATE
+            placeholders = ','.join('?' for _ in question_ids)
+            cursor = conn.execute(f"""
+                UPDATE questions SET subject = NULL, chapter = NULL
+                WHERE id IN ({placeholders}) AND session_id IN (SELECT id FROM sessions WHERE user_id = ?)
+            """, (*question_ids, current_user.id))
+            if cursor.rowcount:
+                bump_suggestions_version(conn, current_user.id)
+        if cursor.rowcount == 0:
             return jsonify({'success': True, 'message': 'No owned questions to delete.'})
 
-        update_placeholders = ','.join('?' for _ in owned_q_ids)
-        conn.execute(f'UPDATE questions SET subject = NULL, chapter = NULL WHERE id IN ({update_placeholders})', owned_q_ids)
-        
-        conn.commit()
-        conn.close()
         return jsonify({'success': True})
     except Exception as e:
         current_app.logger.error(f"Error deleting questions: {repr(e)}")
@@ -140,100 +219,153 @@ def delete_many_classified_questions():
 from rich.table import Table
 from rich.console import Console
 
-@classifier_bp.route('/extract_and_classify_all/<session_id>', methods=['POST'])
-@login_required
-def extract_and_classify_all(session_id):
-    try:
-        conn = get_db_connection()
-        # Security: Check ownership of the session
-        session_owner = conn.execute('SELECT user_id FROM sessions WHERE id = ?', (session_id,)).fetchone()
-        if not session_owner or session_owner['user_id'] != current_user.id:
-            conn.close()
-            return jsonify({'error': 'Unauthorized'}), 403
+def _extract_and_classify(session_id, user_id, classifier_model, processed_folder, report_progress=None):
+    """
+    OCRs every cropped image in a session and classifies the resulting question texts.
+    Returns a (payload, http_status) pair. report_progress(progress, message), when given,
+    is called as the OCR and classification stages advance.
+    """
+    report_progress = report_progress or (lambda progress, message: None)
 
+    with contextlib.closing(get_db_connection()) as conn, conn:
         images = conn.execute(
             "SELECT id, processed_filename FROM images WHERE session_id = ? AND image_type = 'cropped' ORDER BY id", 
             (session_id,)
         ).fetchall()
-        
+    
         if not images:
-            conn.close()
-            return jsonify({'error': 'No cropped images found in session'}), 404
+            return {'error': 'No cropped images found in session'}, 404
 
-        current_app.logger.info(f"Found {len(images)} images to process for user {current_user.id}.")
+        current_app.logger.info(f"Found {len(images)} images to process for user {user_id}.")
 
-        question_texts = []
-        image_ids = []
+        ocr_jobs = []
         for image in images:
-            image_id = image['id']
             processed_filename = image['processed_filename']
-            
+        
             if not processed_filename:
                 continue
-            
-            image_path = os.path.join(current_app.config['PROCESSED_FOLDER'], processed_filename)
-            if not os.path.exists(image_path):
-                continue
-            
-            image_bytes = resize_image_if_needed(image_path)
-            ocr_result = call_nim_ocr_api(image_bytes)
-            
-            current_app.logger.info(f"NVIDIA OCR Result for image {image_id}: {ocr_result}")
-
-            if not ocr_result.get('data') or not ocr_result['data'][0].get('text_detections'):
-                current_app.logger.error(f"NVIDIA OCR result for image {image_id} does not contain 'text_detections' key. Full response: {ocr_result}")
-                continue
+        
+            ocr_jobs.append((image['id'], os.path.join(processed_folder, processed_filename)))
+
+        def run_ocr(jobs):
+            """
+            OCRs a chunk of images in one NIM request; returns (image_id, ocr_result) per image.
+            Images whose exact bytes were OCR'd before are served from ocr_cache instead.
+            """
+            found, results = [], {}
+            for image_id, image_path in jobs:
+                try:
+                    # Opening the file is the existence check; a missing file just skips the image
+                    image_bytes = resize_image_if_needed(image_path)
+                except FileNotFoundError:
+                    results[image_id] = None
+                    continue
+                found.append((image_id, hashlib.blake2b(image_bytes, digest_size=16).hexdigest(), image_bytes))
+
+            cached = fetch_ocr_cache({image_hash for _, image_hash, _ in found})
+            misses = [job for job in found if job[1] not in cached]
+            fresh = call_nim_ocr_api_batch([image_bytes for _, _, image_bytes in misses])
+            # Images NIM failed on come back as None; they are not cached, so a later run retries them
+            fresh = [(image_hash, ocr_result) for (_, image_hash, _), ocr_result in zip(misses, fresh) if ocr_result is not None]
+            store_ocr_cache(fresh)
+            cached.update(fresh)
+
+            results.update((image_id, cached.get(image_hash)) for image_id, image_hash, _ in found)
+            return [(image_id, results[image_id]) for image_id, _ in jobs]
+
+        logger = current_app.logger
+        ocr_chunks = [ocr_jobs[i:i + NIM_BATCH_SIZE] for i in range(0, len(ocr_jobs), NIM_BATCH_SIZE)]
 
-            text = " ".join(item['text_prediction']['text'] for item in ocr_result['data'][0]['text_detections'])
-            
-            conn.execute('UPDATE questions SET question_text = ? WHERE image_id = ?', (text, image_id))
-            current_app.logger.info(f"Updated question_text for image_id: {image_id}")
-            question_texts.append(text)
-            image_ids.append(image_id)
+        batch_size = 7 # Default batch size
 
-        conn.commit()
+        # Choose classifier based on user preference
+        if classifier_model == 'nova':
+            current_app.logger.info(f"Using Nova classifier for user {user_id}")
+            classify, model_name = classify_questions_with_nova, "Nova"
+        else:
+            current_app.logger.info(f"Using Gemini classifier for user {user_id}")
+            classify, model_name = classify_questions_with_gemini, "Gemini"
+
+        def run_batch(batch_texts, start_index):
+            _classifier_rate_limiter.acquire()
+            return classify(batch_texts, start_index=start_index)
+
+        def _batch_result(future, i):
+            # A failed batch only loses its own questions; the other batches are still applied
+            try:
+                return future.result()
+            except Exception as e:
+                logger.error("%s classifier failed for batch %d: %r", model_name, i + 1, e)
+                return None
 
-        # --- Batch Processing and Classification ---
-        batch_size = 7 # Default batch size
-        total_questions = len(question_texts)
-        num_batches = (total_questions + batch_size - 1) // batch_size
-        total_update_count = 0
-
-        for i in range(num_batches):
-            start_index = i * batch_size
-            end_index = start_index + batch_size
-            
-            batch_texts = question_texts[start_index:end_index]
-            batch_image_ids = image_ids[start_index:end_index]
-
-            if not batch_texts:
-                continue
+        question_texts = []
+        image_ids = []
+        ocr_updates = []
+        batch_futures = []
+        # OCR and classification are pipelined: images go to NIM in chunks of NIM_BATCH_SIZE per
+        # request (up to NIM_MAX_CONCURRENCY requests in flight, map() yields in image order), and every
+        # time batch_size texts are ready that batch is handed to the classifier pool while
+        # later images are still being OCR'd. Results are applied on this thread, so the
+        # sqlite connection stays single-threaded.
+        with ThreadPoolExecutor(max_workers=CLASSIFIER_MAX_WORKERS) as classifier_executor:
+            with ThreadPoolExecutor(max_workers=NIM_MAX_CONCURRENCY) as ocr_executor:
+                ocr_results = itertools.chain.from_iterable(ocr_executor.map(run_ocr, ocr_chunks))
+                for done, (image_id, ocr_result) in enumerate(ocr_results, start=1):
+                    report_progress(int(done / len(ocr_jobs) * 50), f'Extracted text from image {done}/{len(ocr_jobs)}')
+                    if ocr_result is None:
+                        logger.warning("No OCR result for image %s (processed file missing or OCR failed), skipping.", image_id)
+                        continue
 
-            current_app.logger.info(f"Processing Batch {i+1}/{num_batches}...")
+                    # The raw result can be KBs of detections; only format it when INFO is actually emitted
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("NVIDIA OCR Result for image %s: %s", image_id, ocr_result)
 
-            # Choose classifier based on user preference
-            classifier_model = getattr(current_user, 'classifier_model', 'gemini')
-            
-            if classifier_model == 'nova':
-                current_app.logger.info(f"Using Nova classifier for user {current_user.id}")
-                classification_result = classify_questions_with_nova(batch_texts, start_index=start_index)
-                model_name = "Nova"
-            else:
-                current_app.logger.info(f"Using Gemini classifier for user {current_user.id}")
-                classification_result = classify_questions_with_gemini(batch_texts, start_index=start_index)
-                model_name = "Gemini"
-            
-            # Log the result to the terminal
-            current_app.logger.info(f"--- Classification Result ({model_name}) for Batch {i+1} ---")
-            current_app.logger.info(json.dumps(classification_result, indent=2))
-            current_app.logger.info("---------------------------------------------")
+                    if not ocr_result.get('data') or not ocr_result['data'][0].get('text_detections'):
+                        logger.error("NVIDIA OCR result for image %s does not contain 'text_detections' key. Full response: %s", image_id, ocr_result)
+                        continue
+
+                    detections = ocr_result['data'][0]['text_detections']
+                    text = " ".join(map(_get_text, map(_get_text_prediction, detections)))
+
+                    ocr_updates.append((text, image_id))
+                    question_texts.append(text)
+                    image_ids.append(image_id)
+
+                    if len(question_texts) % batch_size == 0:
+                        batch_start = len(question_texts) - batch_size
+                        batch_futures.append(classifier_executor.submit(run_batch, question_texts[batch_start:], batch_start))
+
+            # Flush the final partial batch
+            remainder = len(question_texts) % batch_size
+            if remainder:
+                batch_start = len(question_texts) - remainder
+                batch_futures.append(classifier_executor.submit(run_batch, question_texts[batch_start:], batch_start))
+
+            conn.executemany('UPDATE questions SET question_text = ? WHERE image_id = ?', ocr_updates)
+            conn.commit()
+            logger.info("Updated question_text for %d images.", len(ocr_updates))
+
+            # --- Batch Processing and Classification ---
+            total_questions = len(question_texts)
+            num_batches = len(batch_futures)
+            total_update_count = 0
+            current_app.logger.info(f"Waiting on {num_batches} classification batches...")
+            report_progress(50, f'Classifying {total_questions} questions...')
+            batch_results = [_batch_result(future, i) for i, future in enumerate(batch_futures)]
+
+        for i, classification_result in enumerate(batch_results):
+            # Log the result to the terminal; the pretty-printed dump is only built when INFO is emitted
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("--- Classification Result (%s) for Batch %d ---", model_name, i + 1)
+                logger.info(json.dumps(classification_result, indent=2))
+                logger.info("---------------------------------------------")
 
             if not classification_result or not classification_result.get('data'):
                 current_app.logger.error(f'{model_name} classifier did not return valid data for batch {i+1}.')
                 continue # Move to the next batch
 
-            # --- Immediate DB Update for the Batch ---
-            batch_update_count = 0
+            # --- DB Update for the Batch ---
+            classification_updates = {}  # image_id -> (subject, chapter)
             for item in classification_result.get('data', []):
                 item_index_global = item.get('index') # This is the global index (e.g., 1 to 14)
                 if item_index_global is not None:
@@ -249,26 +381,76 @@ def extract_and_classify_all(session_id):
 
                     new_subject = item.get('subject')
                     new_chapter = item.get('chapter_title')
-                    
+                
                     if new_subject and new_subject != 'Unclassified' and new_chapter and new_chapter != 'Unclassified':
-                        conn.execute('UPDATE questions SET subject = ?, chapter = ? WHERE image_id = ?', (new_subject, new_chapter, matched_id))
-                        batch_update_count += 1
+                        classification_updates[matched_id] = (new_subject, new_chapter)
                     elif new_subject and new_subject != 'Unclassified':
-                        conn.execute('UPDATE questions SET subject = ?, chapter = ? WHERE image_id = ?', (new_subject, 'Unclassified', matched_id))
-                        batch_update_count += 1
+                        classification_updates[matched_id] = (new_subject, 'Unclassified')
 
-            conn.commit()
+            _apply_classification_updates(conn, classification_updates)
+            batch_update_count = len(classification_updates)
             total_update_count += batch_update_count
             current_app.logger.info(f"Batch {i+1} processed. Updated {batch_update_count} questions in the database.")
 
-            if i < num_batches - 1:
-                current_app.logger.info("Waiting 5 seconds before next batch...")
-                time.sleep(5)
+        # Every batch has already come back from the classifier, so one commit covers them all
+        if total_update_count:
+            bump_suggestions_version(conn, user_id)
+        conn.commit()
+        return {'success': True, 'message': f'Successfully extracted and classified {total_questions} questions. Updated {total_update_count} entries in the database.'}, 200
+
+def extract_and_classify_background(job_id, session_id, user_id, classifier_model, app):
+    """Background task running _extract_and_classify and recording its progress in classification_jobs."""
+    with app.app_context():
+        set_classification_job(job_id, 'processing', message='Starting...')
+        try:
+            payload, status = _extract_and_classify(
+                session_id, user_id, classifier_model, app.config['PROCESSED_FOLDER'],
+                report_progress=lambda progress, message: set_classification_job(job_id, 'processing', progress, message)
+            )
+            if status == 200:
+                set_classification_job(job_id, 'completed', 100, payload['message'])
+            else:
+                set_classification_job(job_id, 'error', message=payload['error'])
+        except Exception as e:
+            current_app.logger.error(f'Failed to extract and classify questions: {str(e)}', exc_info=True)
+            set_classification_job(job_id, 'error', message=f'Failed to extract and classify questions: {str(e)}')
+
+@classifier_bp.route('/extract_and_classify_all/<session_id>', methods=['POST'])
+@login_required
+def extract_and_classify_all(session_id):
+    try:
+        with contextlib.closing(get_db_connection()) as conn:
+            # Security: Check ownership of the session
+            session_owner = conn.execute('SELECT user_id FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if not session_owner or session_owner['user_id'] != current_user.id:
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        classifier_model = getattr(current_user, 'classifier_model', 'gemini')
 
-        conn.close()
+        # Check for async request: the OCR + classification run can take minutes,
+        # so hand it to a background thread and let the client poll for status
+        if request.args.get('async') == 'true':
+            job_id = uuid.uuid4().hex
+            create_classification_job(job_id, session_id, current_user.id)
+            thread = threading.Thread(
+                target=extract_and_classify_background,
+                args=(job_id, session_id, current_user.id, classifier_model, current_app._get_current_object())
+            )
+            thread.start()
+            return jsonify({'job_id': job_id, 'status': 'processing'}), 202
 
-        return jsonify({'success': True, 'message': f'Successfully extracted and classified {total_questions} questions. Updated {total_update_count} entries in the database.'})
+        payload, status = _extract_and_classify(session_id, current_user.id, classifier_model, current_app.config['PROCESSED_FOLDER'])
+        return jsonify(payload), status
 
     except Exception as e:
         current_app.logger.error(f'Failed to extract and classify questions: {str(e)}', exc_info=True)
         return jsonify({'error': f'Failed to extract and classify questions: {str(e)}'}), 500
+
+@classifier_bp.route('/classified/status/<job_id>')
+@login_required
+def extract_and_classify_status(job_id):
+    """Reports the state of a background extract-and-classify job: {'status', 'progress', 'message'}."""
+    job = fetch_classification_job(job_id, current_user.id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
@@ -1,6 +1,10 @@
 
 import sqlite3
 import os
+import re
+import errno
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 from rich.console import Console
 from rich.table import Table
@@ -17,25 +21,68 @@ DRY_RUN = True  # Set to False to perform actual deletion
 REASON_PERSISTED = "Persisted"
 REASON_NEETPREP = "NeetPrep/JSON"
 REASON_CLASSIFIED = "Classified"
-REASON_RECENT = "Too Recent"
+
+# Filenames that mark JSON/NeetPrep imports, matched case-insensitively without lowercasing each row
+NEETPREP_RE = re.compile(r'\.json|neetprep', re.IGNORECASE)
+JSON_UPLOAD_RE = re.compile(r'json upload', re.IGNORECASE)
 
 def get_db_connection():
     """Establishes a connection to the SQLite database."""
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    # Same settings as the app's pooled connections: WAL with NORMAL sync skips the full fsync per commit
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
     return conn
 
-def is_classified_session(conn, session_id):
-    """Checks if a session contains any classified questions."""
-    if not session_id:
-        return False
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT 1 FROM questions 
-        WHERE session_id = ? AND subject IS NOT NULL AND chapter IS NOT NULL 
-        LIMIT 1
-    """, (session_id,))
-    return cursor.fetchone() is not None
+# Stays under SQLite's default host-parameter limit on older builds
+SQL_CHUNK_SIZE = 500
+
+def _chunked(ids, size=SQL_CHUNK_SIZE):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def get_classified_session_ids(conn):
+    """Returns the set of session IDs that contain at least one classified question."""
+    return {row['session_id'] for row in conn.execute("""
+        SELECT DISTINCT session_id FROM questions 
+        WHERE subject IS NOT NULL AND chapter IS NOT NULL
+    """)}
+
+def _scan_folder_usage(folder):
+    """Returns (total_size, file_count) for the regular files under folder, skipping symlinks."""
+    total_size = 0
+    file_count = 0
+    pending = [folder]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                # DirEntry caches the type and lstat result, so no extra stat per file
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        total_size += entry.stat(follow_symlinks=False).st_size
+                        file_count += 1
+                    except FileNotFoundError:
+                        pass
+    return total_size, file_count
+
+def _scan_file_sizes(folder):
+    """Returns {filename: size} for the regular files directly inside folder, skipping symlinks."""
+    try:
+        entries = os.scandir(folder)
+    except FileNotFoundError:
+        return {}
+    with entries:
+        # DirEntry caches the type and lstat result, so this is one directory sweep
+        return {entry.name: entry.stat(follow_symlinks=False).st_size
+                for entry in entries if entry.is_file(follow_symlinks=False)}
 
 def show_disk_usage_report(console):
     """Calculates and displays a report of disk usage by category."""
@@ -58,20 +105,7 @@ def show_disk_usage_report(console):
     }
 
     for category, folder in folders_to_scan.items():
-        total_size = 0
-        file_count = 0
-        try:
-            for dirpath, _, filenames in os.walk(folder):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    if not os.path.islink(fp):
-                        try:
-                            total_size += os.path.getsize(fp)
-                            file_count += 1
-                        except FileNotFoundError:
-                            pass
-        except FileNotFoundError:
-            pass 
+        total_size, file_count = _scan_folder_usage(folder)
         usage_data[category] = {"size": total_size, "count": file_count}
         
     summary_table = Table(title="Disk Space Usage by Category")
@@ -95,33 +129,33 @@ def show_disk_usage_report(console):
     console.print("\n[bold]Breakdown of 'Uploaded Originals':[/bold]")
     
     conn = get_db_connection()
-    sessions = conn.execute('SELECT id, original_filename FROM sessions').fetchall()
     
     session_sizes = []
     with console.status("[cyan]Calculating size per session...[/cyan]"):
-        for session in sessions:
-            session_id = session['id']
-            images = conn.execute("SELECT filename FROM images WHERE session_id = ? AND image_type = 'original'", (session_id,)).fetchall()
-            
-            total_size = 0
-            file_count = 0
-            for img in images:
-                if not img['filename']: continue
-                try:
-                    fp = os.path.join(UPLOAD_FOLDER, img['filename'])
-                    if not os.path.islink(fp):
-                        total_size += os.path.getsize(fp)
-                        file_count += 1
-                except FileNotFoundError:
-                    pass # File may not exist, that's okay
-            
-            if file_count > 0:
-                session_sizes.append({
-                    "id": session_id,
-                    "name": session['original_filename'],
-                    "size": total_size,
-                    "count": file_count
-                })
+        # One query for every session's originals instead of one per session
+        rows = conn.execute("""
+            SELECT s.id, s.original_filename, i.filename
+            FROM sessions s JOIN images i ON i.session_id = s.id
+            WHERE i.image_type = 'original' AND i.filename IS NOT NULL AND i.filename != ''
+        """).fetchall()
+
+        # One scan of the upload folder instead of a stat() per image row
+        file_sizes = _scan_file_sizes(UPLOAD_FOLDER)
+
+        by_session = {}
+        for row in rows:
+            size = file_sizes.get(row['filename'])
+            if size is None:
+                continue # File may not exist, that's okay
+            entry = by_session.setdefault(row['id'], {
+                "id": row['id'],
+                "name": row['original_filename'],
+                "size": 0,
+                "count": 0
+            })
+            entry["size"] += size
+            entry["count"] += 1
+        session_sizes = list(by_session.values())
 
     # Sort sessions by size, descending
     session_sizes.sort(key=lambda x: x['size'], reverse=True)
@@ -159,24 +193,25 @@ def main():
     
     sessions_to_delete = []
     pdfs_to_delete = []
+    # One query up front instead of a lookup per session and per PDF
+    classified_sessions = get_classified_session_ids(conn)
     
     # --- 1. Identify Sessions to Delete ---
-    all_sessions = conn.execute('SELECT id, created_at, original_filename, persist FROM sessions').fetchall()
+    # created_at is stored as 'YYYY-MM-DD HH:MM:SS', which compares correctly as text, so
+    # SQLite drops the too-recent rows before Python has to parse any timestamps
+    cutoff_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
+    all_sessions = conn.execute('SELECT id, created_at, original_filename, persist FROM sessions WHERE created_at <= ?', (cutoff_str,)).fetchall()
     
     with console.status("[cyan]Analyzing sessions...[/cyan]") as status:
         for session in all_sessions:
             session_id = session['id']
             reason = ""
             
-            created_at = datetime.fromisoformat(session['created_at'])
-            
-            if created_at > cutoff_date:
-                reason = REASON_RECENT
-            elif session['persist'] == 1:
+            if session['persist'] == 1:
                 reason = REASON_PERSISTED
-            elif session['original_filename'] and ('.json' in session['original_filename'].lower() or 'neetprep' in session['original_filename'].lower()):
+            elif session['original_filename'] and NEETPREP_RE.search(session['original_filename']):
                 reason = REASON_NEETPREP
-            elif is_classified_session(conn, session_id):
+            elif session_id in classified_sessions:
                 reason = REASON_CLASSIFIED
 
             if not reason:
@@ -184,23 +219,19 @@ def main():
             status.update(f"[cyan]Analyzed {len(all_sessions)} sessions. Found {len(sessions_to_delete)} candidates for deletion.[/cyan]")
 
     # --- 2. Identify Generated PDFs to Delete ---
-    all_pdfs = conn.execute('SELECT id, session_id, filename, created_at, persist, source_filename, notes FROM generated_pdfs').fetchall()
+    all_pdfs = conn.execute('SELECT id, session_id, filename, created_at, persist, source_filename, notes FROM generated_pdfs WHERE created_at <= ?', (cutoff_str,)).fetchall()
 
     with console.status("[cyan]Analyzing generated PDFs...[/cyan]") as status:
         for pdf in all_pdfs:
             reason = ""
             
-            created_at = datetime.fromisoformat(pdf['created_at'])
-            
-            if created_at > cutoff_date:
-                reason = REASON_RECENT
-            elif pdf['persist'] == 1:
+            if pdf['persist'] == 1:
                 reason = REASON_PERSISTED
-            elif pdf['source_filename'] and ('.json' in pdf['source_filename'].lower() or 'neetprep' in pdf['source_filename'].lower()):
+            elif pdf['source_filename'] and NEETPREP_RE.search(pdf['source_filename']):
                 reason = REASON_NEETPREP
-            elif pdf['notes'] and 'json upload' in pdf['notes'].lower():
+            elif pdf['notes'] and JSON_UPLOAD_RE.search(pdf['notes']):
                 reason = REASON_NEETPREP
-            elif is_classified_session(conn, pdf['session_id']):
+            elif pdf['session_id'] in classified_sessions:
                 reason = REASON_CLASSIFIED
 
             if not reason:
@@ -220,12 +251,14 @@ def main():
         conn.close()
         return
 
+    # Only the (small) deletion lists need their timestamps parsed, for the age column
+    now = datetime.now()
     for session in sessions_to_delete:
-        age = (datetime.now() - datetime.fromisoformat(session['created_at'])).days
+        age = (now - datetime.fromisoformat(session['created_at'])).days
         table.add_row("Session", session['id'], session['created_at'], str(age), session['original_filename'])
 
     for pdf in pdfs_to_delete:
-        age = (datetime.now() - datetime.fromisoformat(pdf['created_at'])).days
+        age = (now - datetime.fromisoformat(pdf['created_at'])).days
         table.add_row("Generated PDF", pdf['filename'], pdf['created_at'], str(age), f"Source: {pdf['source_filename']}")
         
     console.print(table)
@@ -237,47 +270,48 @@ def main():
         # --- 4. Perform Deletion ---
         console.print("\n[bold red]PERFORMING DELETION...[/bold red]")
         
-        # Delete Sessions and associated files
-        for session in sessions_to_delete:
-            session_id = session['id']
-            console.print(f"Deleting session [cyan]{session_id}[/cyan]...")
-            images_to_delete = conn.execute('SELECT filename, processed_filename FROM images WHERE session_id = ?', (session_id,)).fetchall()
-            for img in images_to_delete:
+        session_ids = [session['id'] for session in sessions_to_delete]
+        pdf_ids = [pdf['id'] for pdf in pdfs_to_delete]
+        files_to_remove = []
+
+        # All DB deletions happen in one write transaction with one statement per table
+        # (per chunk of ids); the files are only removed once it has committed.
+        conn.execute('BEGIN IMMEDIATE')
+        for chunk in _chunked(session_ids):
+            placeholders = ','.join('?' * len(chunk))
+            conn.execute(f'DELETE FROM questions WHERE session_id IN ({placeholders})', chunk)
+            for img in conn.execute(f'DELETE FROM images WHERE session_id IN ({placeholders}) RETURNING filename, processed_filename', chunk).fetchall():
                 if img['filename']:
-                    try:
-                        f_path = os.path.join(UPLOAD_FOLDER, img['filename'])
-                        os.remove(f_path)
-                        console.print(f"  - Deleted upload: [dim]{f_path}[/dim]")
-                    except OSError as e:
-                        console.print(f"  - [red]Error deleting {f_path}: {e}[/red]")
+                    files_to_remove.append(("upload", os.path.join(UPLOAD_FOLDER, img['filename'])))
                 if img['processed_filename']:
-                    try:
-                        f_path = os.path.join(PROCESSED_FOLDER, img['processed_filename'])
-                        os.remove(f_path)
-                        console.print(f"  - Deleted processed: [dim]{f_path}[/dim]")
-                    except OSError as e:
-                        console.print(f"  - [red]Error deleting {f_path}: {e}[/red]")
-            
-            conn.execute('DELETE FROM questions WHERE session_id = ?', (session_id,))
-            conn.execute('DELETE FROM images WHERE session_id = ?', (session_id,))
-            conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
-            console.print(f"  - Deleted DB records for session {session_id}")
-
-        # Delete Generated PDFs and their files
-        for pdf in pdfs_to_delete:
-            pdf_id, pdf_filename = pdf['id'], pdf['filename']
-            console.print(f"Deleting generated PDF [cyan]{pdf_filename}[/cyan]...")
+                    files_to_remove.append(("processed", os.path.join(PROCESSED_FOLDER, img['processed_filename'])))
+            conn.execute(f'DELETE FROM sessions WHERE id IN ({placeholders})', chunk)
+        for chunk in _chunked(pdf_ids):
+            placeholders = ','.join('?' * len(chunk))
+            for pdf in conn.execute(f'DELETE FROM generated_pdfs WHERE id IN ({placeholders}) RETURNING filename', chunk).fetchall():
+                files_to_remove.append(("generated PDF", os.path.join(OUTPUT_FOLDER, pdf['filename'])))
+        conn.commit()
+        console.print(f"  - Deleted DB records for {len(session_ids)} sessions and {len(pdf_ids)} generated PDFs")
+
+        # Files are first renamed into a per-run trash directory, which takes them out of the
+        # served folders immediately, then the whole directory is removed in one rmtree.
+        trash_dir = tempfile.mkdtemp(prefix='cleanup_', dir='.')
+        removed = {}
+        for n, (kind, f_path) in enumerate(files_to_remove):
             try:
-                f_path = os.path.join(OUTPUT_FOLDER, pdf_filename)
-                os.remove(f_path)
-                console.print(f"  - Deleted file: [dim]{f_path}[/dim]")
+                try:
+                    os.replace(f_path, os.path.join(trash_dir, f"{n}_{os.path.basename(f_path)}"))
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    os.remove(f_path)  # On another filesystem than the trash directory
+                removed[kind] = removed.get(kind, 0) + 1
             except OSError as e:
-                console.print(f"  - [red]Error deleting {f_path}: {e}[/red]")
-            
-            conn.execute('DELETE FROM generated_pdfs WHERE id = ?', (pdf_id,))
-            console.print(f"  - Deleted DB record for PDF {pdf_id}")
+                console.print(f"  - [red]Error deleting {f_path}: {e.strerror}[/red]")
+        shutil.rmtree(trash_dir, ignore_errors=True)
+        for kind, count in removed.items():
+            console.print(f"  - Deleted {count} {kind} file(s)")
 
-        conn.commit()
         console.print("\n[bold green]Deletion complete.[/bold green]")
 
     conn.close()
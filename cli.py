@@ -1,13 +1,17 @@
+import multiprocessing
 import os
 import re
+import shutil
 import sqlite3
 import sys
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
 import click
 import fitz  # PyMuPDF
 import requests
+from requests.adapters import HTTPAdapter
 from rich.progress import (
     BarColumn,
     Progress,
@@ -16,28 +20,39 @@ from rich.progress import (
     TimeElapsedColumn,
     TimeRemainingColumn,
 )
-from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
 
 # --- Configuration ---
-from utils import get_db_connection
+from utils import get_db_connection, stream_response_to_file, PAGE_JPEG_QUALITY
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 UPLOAD_FOLDER = os.path.join(SCRIPT_DIR, 'uploads')
 PROCESSED_FOLDER = os.path.join(SCRIPT_DIR, 'processed')
 OUTPUT_FOLDER = os.path.join(SCRIPT_DIR, 'output')
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(PROCESSED_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
+_dirs_ready = False
 
+def _ensure_dirs():
+    """Creates the upload/processed/output folders, once per process and only for commands that write files."""
+    global _dirs_ready
+    if _dirs_ready:
+        return
+    for folder in (UPLOAD_FOLDER, PROCESSED_FOLDER, OUTPUT_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+    _dirs_ready = True
 
 # --- Core Logic Functions (mirrored from app.py) ---
+# Bump whenever setup_database_cli changes the schema, so existing databases pick the change up
+CLI_SCHEMA_VERSION = 2
+
 def setup_database_cli():
     """Initializes the database and creates/updates tables as needed."""
     conn = get_db_connection()
     cursor = conn.cursor()
+    # Already set up by this (or a newer) version: skip the CREATE/ALTER probes entirely
+    if cursor.execute('PRAGMA user_version').fetchone()[0] >= CLI_SCHEMA_VERSION:
+        conn.close()
+        return
     click.echo("Creating/updating tables...")
 
     cursor.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, original_filename TEXT, persist INTEGER DEFAULT 0, subject TEXT, tags TEXT, notes TEXT);")
@@ -67,37 +82,85 @@ def setup_database_cli():
     except sqlite3.OperationalError:
         cursor.execute("ALTER TABLE questions ADD COLUMN tags TEXT")
 
+    # Same indexes as the app's setup_database; they back cleanup's age filter and add-question's MAX(image_index)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_images_session_index ON images(session_id, image_index)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_questions_session ON questions(session_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_sessions_persist_created ON sessions(persist, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_generated_pdfs_persist_created ON generated_pdfs(persist, created_at)")
+
+    cursor.execute(f"PRAGMA user_version = {CLI_SCHEMA_VERSION}")
     click.echo("Tables created successfully.")
     conn.commit()
     conn.close()
 
+def _list_folder(folder):
+    """Returns the set of entry names in folder (empty if it does not exist)."""
+    try:
+        with os.scandir(folder) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
 def cleanup_old_data_cli():
     """Removes sessions, files, and PDFs older than 1 day, unless persisted."""
     conn = get_db_connection()
+    conn.row_factory = None  # Plain tuples: rows here are only ever unpacked positionally
     cutoff = datetime.now() - timedelta(days=1)
     click.echo(f"Starting cleanup for items older than {cutoff.strftime('%Y-%m-%d %H:%M:%S')}:")
 
-    old_sessions = conn.execute('SELECT id FROM sessions WHERE created_at < ? AND persist = 0', (cutoff,)).fetchall()
-    click.echo(f"Found {len(old_sessions)} old, non-persisted sessions to delete.")
-    for session in old_sessions:
-        session_id = session['id']
-        images_to_delete = conn.execute('SELECT filename, processed_filename FROM images WHERE session_id = ?', (session_id,)).fetchall()
-        for img in images_to_delete:
-            if img['filename'] and os.path.exists(os.path.join(UPLOAD_FOLDER, img['filename'])): os.remove(os.path.join(UPLOAD_FOLDER, img['filename']))
-            if img['processed_filename'] and os.path.exists(os.path.join(PROCESSED_FOLDER, img['processed_filename'])): os.remove(os.path.join(PROCESSED_FOLDER, img['processed_filename']))
-        conn.execute('DELETE FROM questions WHERE session_id = ?', (session_id,))
-        conn.execute('DELETE FROM images WHERE session_id = ?', (session_id,))
-        conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
-
-    old_pdfs = conn.execute('SELECT id, filename FROM generated_pdfs WHERE created_at < ? AND persist = 0', (cutoff,)).fetchall()
-    click.echo(f"Found {len(old_pdfs)} old, non-persisted generated PDFs to delete.")
-    for pdf in old_pdfs:
-        if os.path.exists(os.path.join(OUTPUT_FOLDER, pdf['filename'])): os.remove(os.path.join(OUTPUT_FOLDER, pdf['filename']))
-        conn.execute('DELETE FROM generated_pdfs WHERE id = ?', (pdf['id'],))
+    # One directory listing per folder instead of an exists() stat per file
+    upload_files = _list_folder(UPLOAD_FOLDER)
+    processed_files = _list_folder(PROCESSED_FOLDER)
+    output_files = _list_folder(OUTPUT_FOLDER)
+
+    # Set-based deletes: each table is cleaned with one statement, and RETURNING hands back
+    # the filenames to remove, so nothing is looked up per session or per PDF.
+    old_sessions = 'SELECT id FROM sessions WHERE created_at < ? AND persist = 0'
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute(f'DELETE FROM questions WHERE session_id IN ({old_sessions})', (cutoff,))
+    deleted_images = conn.execute(
+        f'DELETE FROM images WHERE session_id IN ({old_sessions}) RETURNING filename, processed_filename', (cutoff,)
+    ).fetchall()
+    deleted_sessions = conn.execute('DELETE FROM sessions WHERE created_at < ? AND persist = 0 RETURNING id', (cutoff,)).fetchall()
+    click.echo(f"Found {len(deleted_sessions)} old, non-persisted sessions to delete.")
+
+    deleted_pdfs = conn.execute('DELETE FROM generated_pdfs WHERE created_at < ? AND persist = 0 RETURNING filename', (cutoff,)).fetchall()
+    click.echo(f"Found {len(deleted_pdfs)} old, non-persisted generated PDFs to delete.")
 
     conn.commit()
     conn.close()
 
+    # Files go only once the rows are gone for good
+    for filename, processed_filename in deleted_images:
+        if filename in upload_files: os.unlink(os.path.join(UPLOAD_FOLDER, filename))
+        if processed_filename in processed_files: os.unlink(os.path.join(PROCESSED_FOLDER, processed_filename))
+    for (filename,) in deleted_pdfs:
+        if filename in output_files: os.unlink(os.path.join(OUTPUT_FOLDER, filename))
+
+# Filename from a Content-Disposition header
+_CD_FILENAME_RE = re.compile(r'filename="([^"]+)"')
+
+# One keep-alive session for all downloads in a run, so several URLs from the same host
+# (e.g. a comma-separated batch of Drive links) don't each pay a new TCP/TLS handshake
+_download_session = requests.Session()
+_download_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+# (connect, read) timeouts for PDF downloads
+DOWNLOAD_TIMEOUT = (5, 60)
+# How many upcoming files in a comma-separated upload are downloaded ahead of the one being rendered
+DOWNLOAD_PREFETCH = 4
+
+PDF_MAGIC = b'%PDF'
+
+def _drive_confirm_token(response):
+    """Returns the token needed to get past Drive's large-file warning page, or None if there is none."""
+    for name, value in response.cookies.items():
+        if name.startswith('download_warning'):
+            return value
+    # Newer Drive responses carry no cookie; the interstitial itself is HTML and 't' confirms it
+    if response.headers.get('content-type', '').startswith('text/html'):
+        return 't'
+    return None
+
 def _get_local_pdf_path(path_or_url):
     """
     Takes a path or URL. If it's a URL, downloads it to the UPLOAD_FOLDER.
@@ -110,25 +173,37 @@ def _get_local_pdf_path(path_or_url):
             if "drive.google.com" in path_or_url:
                 file_id = path_or_url.split('/')[-2]
                 download_url = f'https://drive.google.com/uc?export=download&id={file_id}'
-                response = requests.get(download_url, stream=True)
+                response = _download_session.get(download_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+                # Files too large for Drive's virus scan come back as an HTML "download anyway" page;
+                # follow its confirm token instead of saving that page as the PDF
+                confirm_token = _drive_confirm_token(response)
+                if confirm_token:
+                    response.close()
+                    response = _download_session.get(download_url, params={'confirm': confirm_token},
+                                                     stream=True, timeout=DOWNLOAD_TIMEOUT)
+                response.raise_for_status()
                 content_disposition = response.headers.get('content-disposition')
                 if content_disposition:
-                    filenames = re.findall('filename="(.+)"', content_disposition)
+                    filenames = _CD_FILENAME_RE.findall(content_disposition)
                     original_name = secure_filename(filenames[0]) if filenames else f"{str(uuid.uuid4())}.pdf"
                 else:
                     original_name = f"{str(uuid.uuid4())}.pdf"
             elif path_or_url.lower().endswith('.pdf'):
-                response = requests.get(path_or_url, stream=True)
+                response = _download_session.get(path_or_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
                 response.raise_for_status()
                 original_name = secure_filename(path_or_url.split('/')[-1]) or f"{str(uuid.uuid4())}.pdf"
             else:
                 raise ValueError("URL is not a recognized Google Drive or direct .pdf link.")
 
-            local_path = os.path.join(UPLOAD_FOLDER, f"temp_{original_name}")
-            with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
+            # Unique per download, since the next file may be fetched while this one is still in use
+            local_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4().hex[:8]}_{original_name}")
+            stream_response_to_file(response, local_path)
+            with open(local_path, 'rb') as f:
+                is_pdf = f.read(len(PDF_MAGIC)) == PDF_MAGIC
+            if not is_pdf:
+                os.remove(local_path)
+                raise ValueError("Downloaded file is not a PDF.")
+
             return local_path, original_name, True
         except Exception as e:
             click.secho(f"Error downloading file: {e}", fg="red", err=True)
@@ -139,6 +214,57 @@ def _get_local_pdf_path(path_or_url):
             return None, None, False
         return path_or_url, secure_filename(os.path.basename(path_or_url)), False
 
+# Write buffer for --log output
+LOG_BUFFER_SIZE = 64 * 1024
+# Rows per executemany call when recording rendered pages
+INSERT_BATCH_SIZE = 10000
+# WAL auto-checkpoint threshold (pages) while recording an upload, and SQLite's default to restore afterwards
+BULK_WAL_AUTOCHECKPOINT = 100000
+DEFAULT_WAL_AUTOCHECKPOINT = 1000
+# Default upload render resolution; pages are rendered as opaque RGB since JPEG has no alpha anyway
+DEFAULT_RENDER_DPI = 150
+
+# Rasterizer processes per upload; defaults to one per CPU
+RENDER_MAX_WORKERS = max(1, int(os.getenv('RENDER_MAX_WORKERS', os.cpu_count() or 1)))
+
+_render_doc = None
+_render_matrix = None
+
+def _init_render_worker(pdf_path, dpi):
+    """Opens the PDF and builds the zoom matrix once per worker, so each page task only has to rasterize."""
+    global _render_doc, _render_matrix
+    _render_doc = fitz.open(pdf_path)
+    _render_matrix = fitz.Matrix(dpi / 72, dpi / 72)
+
+def _render_page(page_index, page_path):
+    pix = _render_doc[page_index].get_pixmap(matrix=_render_matrix, colorspace=fitz.csRGB, alpha=False)
+    pix.save(page_path, jpg_quality=PAGE_JPEG_QUALITY)
+    return page_index
+
+def _render_pages(pdf_path, page_jobs, dpi=DEFAULT_RENDER_DPI):
+    """
+    Rasterizes (page_index, page_path) jobs on a process pool of up to RENDER_MAX_WORKERS processes.
+    Yields each page index as its image is written (completion order, not page order).
+    """
+    workers = min(len(page_jobs), RENDER_MAX_WORKERS)
+    if workers == 1:
+        # Not worth starting a pool for a single page or a single allowed worker
+        global _render_doc
+        _init_render_worker(pdf_path, dpi)
+        try:
+            for page_index, page_path in page_jobs:
+                yield _render_page(page_index, page_path)
+        finally:
+            _render_doc.close()
+            _render_doc = None
+        return
+    # forkserver: upload() may have a download thread running, which makes a plain fork unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=_init_render_worker, initargs=(pdf_path, dpi)) as executor:
+        futures = [executor.submit(_render_page, i, page_path) for i, page_path in page_jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
 # --- CLI Group ---
 @click.group()
 def cli():
@@ -172,6 +298,7 @@ def db_cleanup():
 def add_question(session_id, image_path, q_num, status, marked_ans, correct_ans, subject, time):
     """Adds a single question with metadata to the database."""
     setup_database_cli()  # Ensure database tables exist
+    _ensure_dirs()
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -180,8 +307,7 @@ def add_question(session_id, image_path, q_num, status, marked_ans, correct_ans,
         original_filename = secure_filename(os.path.basename(image_path))
         processed_filename = f"processed_{session_id}_{str(uuid.uuid4())[:8]}_{original_filename}"
         processed_path = os.path.join(PROCESSED_FOLDER, processed_filename)
-        import shutil
-        shutil.copy(image_path, processed_path)
+        shutil.copyfile(image_path, processed_path)
 
         # 2. Create a new image record
         # Find the next available image_index for the session
@@ -219,15 +345,19 @@ def add_question(session_id, image_path, q_num, status, marked_ans, correct_ans,
 @click.option('--tags', type=click.STRING, help='Tags for the final PDF (comma-separated).')
 @click.option('--notes', type=click.STRING, help='Notes for the final PDF.')
 @click.option('--log', is_flag=True, help='Log all output to cli.log.')
-def upload(pdf_paths, simple_progress, final, subject, tags, notes, log):
+@click.option('--dpi', type=click.IntRange(36, 600), default=DEFAULT_RENDER_DPI, show_default=True,
+              help='Page render resolution. Render time grows with the square of the DPI.')
+def upload(pdf_paths, simple_progress, final, subject, tags, notes, log, dpi):
     """
     A CLI tool to upload a large PDF directly to the application's database.
     PDF_PATHS: A comma-separated list of full paths to the PDF files you wish to upload or Google Drive URLs.
     """
     setup_database_cli()  # Ensure database tables exist
+    _ensure_dirs()
     if log:
         try:
-            log_f = open('cli.log', 'a')
+            # Block-buffered so each echoed line isn't its own write() to disk
+            log_f = open('cli.log', 'a', buffering=LOG_BUFFER_SIZE)
             sys.stdout = log_f
             sys.stderr = log_f
         except Exception as e:
@@ -235,120 +365,130 @@ def upload(pdf_paths, simple_progress, final, subject, tags, notes, log):
             raise click.Abort()
 
     click.echo(f"--- Log entry: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
-    click.echo(f"Arguments: pdf_paths={pdf_paths}, simple_progress={simple_progress}, final={final}, subject={subject}, tags={tags}, notes={notes}, log={log}")
+    click.echo(f"Arguments: pdf_paths={pdf_paths}, simple_progress={simple_progress}, final={final}, subject={subject}, tags={tags}, notes={notes}, log={log}, dpi={dpi}")
     click.echo("---" * 20)
 
     files_to_process = [p.strip() for p in pdf_paths.split(',')]
 
-    for pdf_path_or_url in files_to_process:
-        click.secho(f"--- Processing: {click.style(pdf_path_or_url, bold=True)} ---", fg="yellow")
+    # While one PDF is being rendered (already spread over every core), the next
+    # DOWNLOAD_PREFETCH files are downloading in the background, several at a time
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_PREFETCH) as prefetcher:
+        downloads = [prefetcher.submit(_get_local_pdf_path, path) for path in files_to_process[:DOWNLOAD_PREFETCH]]
+        for n, pdf_path_or_url in enumerate(files_to_process):
+            click.secho(f"--- Processing: {click.style(pdf_path_or_url, bold=True)} ---", fg="yellow")
 
-        local_pdf_path, original_filename, is_temp = _get_local_pdf_path(pdf_path_or_url)
+            local_pdf_path, original_filename, is_temp = downloads[n].result()
+            if n + DOWNLOAD_PREFETCH < len(files_to_process):
+                downloads.append(prefetcher.submit(_get_local_pdf_path, files_to_process[n + DOWNLOAD_PREFETCH]))
 
-        if not local_pdf_path:
-            continue
+            if not local_pdf_path:
+                continue
 
-        try:
-            if final:
-                if not subject:
-                    click.secho("Error: --subject is required when using --final.", fg="red", err=True)
-                    raise click.Abort()
-
-                session_id = str(uuid.uuid4())
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('INSERT INTO sessions (id, original_filename) VALUES (?, ?)',
-                               (session_id, original_filename))
-
-                output_filename = original_filename
-                output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-
-                if os.path.exists(output_path):
-                    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                    output_filename = f"{timestamp}_{original_filename}"
+            try:
+                if final:
+                    if not subject:
+                        click.secho("Error: --subject is required when using --final.", fg="red", err=True)
+                        raise click.Abort()
+
+                    session_id = str(uuid.uuid4())
+                    output_filename = original_filename
                     output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-                    click.secho(f"Warning: File '{original_filename}' already exists. Saving as '{output_filename}'.", fg="yellow")
-
-                import shutil
-                shutil.copy(local_pdf_path, output_path)
-
-                cursor.execute(
-                    'INSERT INTO generated_pdfs (session_id, filename, subject, tags, notes, source_filename) VALUES (?, ?, ?, ?, ?, ?)',
-                    (session_id, output_filename, subject, tags, notes, original_filename)
-                )
-                conn.commit()
-                conn.close()
-                click.secho(f"Successfully added final PDF '{original_filename}' to the database.", fg="green")
-
-            else: # Standard page-extraction mode
-                click.echo(f"Processing PDF: {click.style(original_filename, bold=True)}")
-                session_id = str(uuid.uuid4())
-                doc = fitz.open(local_pdf_path)
-                num_pages = len(doc)
-                if num_pages == 0:
-                    click.secho("Warning: This PDF has 0 pages. Nothing to process.", fg="yellow")
-                    continue
-
-                click.echo(f"PDF contains {num_pages} pages to process.")
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('INSERT INTO sessions (id, original_filename) VALUES (?, ?)',
-                               (session_id, original_filename))
-                click.echo(f"Created session: {click.style(session_id, fg='cyan')}")
-
-                images_to_insert = []
-
-                if simple_progress:
-                    for i, page in enumerate(doc):
-                        pix = page.get_pixmap(dpi=150)
-                        page_filename = f"{session_id}_page_{i}.png"
-                        page_path = os.path.join(UPLOAD_FOLDER, page_filename)
-                        pix.save(page_path)
-                        images_to_insert.append(
-                            (session_id, i, page_filename, f"Page {i + 1}", 'original')
+
+                    if os.path.exists(output_path):
+                        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+                        output_filename = f"{timestamp}_{original_filename}"
+                        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+                        click.secho(f"Warning: File '{original_filename}' already exists. Saving as '{output_filename}'.", fg="yellow")
+
+                    shutil.copyfile(local_pdf_path, output_path)
+
+                    # Both rows go in one short transaction after the copy, not around it
+                    conn = get_db_connection()
+                    try:
+                        conn.execute('BEGIN IMMEDIATE')
+                        conn.execute('INSERT INTO sessions (id, original_filename) VALUES (?, ?)',
+                                     (session_id, original_filename))
+                        conn.execute(
+                            'INSERT INTO generated_pdfs (session_id, filename, subject, tags, notes, source_filename) VALUES (?, ?, ?, ?, ?, ?)',
+                            (session_id, output_filename, subject, tags, notes, original_filename)
                         )
-                        percentage = int(((i + 1) / num_pages) * 100)
-                        sys.stdout.write(f"{percentage}\n")
-                        sys.stdout.flush()
-                else:
-                    progress = Progress(
-                        SpinnerColumn(),
-                        TextColumn("[progress.description]{task.description}"),
-                        BarColumn(bar_width=None),
-                        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-                        TextColumn("• Page {task.completed}/{task.total}"),
-                        TextColumn("• Elapsed:"), TimeElapsedColumn(),
-                        TextColumn("• Remaining:"), TimeRemainingColumn(),
-                    )
-                    with progress:
-                        task = progress.add_task("[green]Extracting pages...", total=num_pages)
-                        for i, page in enumerate(doc):
-                            pix = page.get_pixmap(dpi=150)
-                            page_filename = f"{session_id}_page_{i}.png"
-                            page_path = os.path.join(UPLOAD_FOLDER, page_filename)
-                            pix.save(page_path)
-                            images_to_insert.append(
-                                (session_id, i, page_filename, f"Page {i + 1}", 'original')
+                        conn.commit()
+                    finally:
+                        conn.close()
+                    click.secho(f"Successfully added final PDF '{original_filename}' to the database.", fg="green")
+
+                else: # Standard page-extraction mode
+                    click.echo(f"Processing PDF: {click.style(original_filename, bold=True)}")
+                    session_id = str(uuid.uuid4())
+                    with fitz.open(local_pdf_path) as doc:
+                        num_pages = len(doc)
+                    if num_pages == 0:
+                        click.secho("Warning: This PDF has 0 pages. Nothing to process.", fg="yellow")
+                        continue
+
+                    click.echo(f"PDF contains {num_pages} pages to process.")
+
+                    page_jobs = [(i, os.path.join(UPLOAD_FOLDER, f"{session_id}_page_{i}.jpg")) for i in range(num_pages)]
+                    images_to_insert = [
+                        (session_id, i, os.path.basename(page_path), f"Page {i + 1}", 'original')
+                        for i, page_path in page_jobs
+                    ]
+
+                    if simple_progress:
+                        for done, _ in enumerate(_render_pages(local_pdf_path, page_jobs, dpi), start=1):
+                            percentage = int((done / num_pages) * 100)
+                            sys.stdout.write(f"{percentage}\n")
+                            sys.stdout.flush()
+                    else:
+                        progress = Progress(
+                            SpinnerColumn(),
+                            TextColumn("[progress.description]{task.description}"),
+                            BarColumn(bar_width=None),
+                            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+                            TextColumn("• Page {task.completed}/{task.total}"),
+                            TextColumn("• Elapsed:"), TimeElapsedColumn(),
+                            TextColumn("• Remaining:"), TimeRemainingColumn(),
+                            # update() only records progress; repaints happen on this timer, so a low
+                            # rate keeps terminal redraws from competing with the render loop
+                            refresh_per_second=4,
+                        )
+                        with progress:
+                            task = progress.add_task("[green]Extracting pages...", total=num_pages)
+                            for _ in _render_pages(local_pdf_path, page_jobs, dpi):
+                                progress.update(task, advance=1)
+
+                    # The session and its pages are written together once rendering is done, so the
+                    # write lock is held for one short transaction rather than the whole render.
+                    click.echo("\nInserting image records into the database...")
+                    conn = get_db_connection()
+                    try:
+                        # Avoid checkpointing partway through a large insert; the default is
+                        # restored below before the pooled connection is handed back
+                        conn.execute(f'PRAGMA wal_autocheckpoint = {BULK_WAL_AUTOCHECKPOINT}')
+                        conn.execute('BEGIN IMMEDIATE')
+                        conn.execute('INSERT INTO sessions (id, original_filename) VALUES (?, ?)',
+                                     (session_id, original_filename))
+                        for start in range(0, len(images_to_insert), INSERT_BATCH_SIZE):
+                            conn.executemany(
+                                'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
+                                images_to_insert[start:start + INSERT_BATCH_SIZE]
                             )
-                            progress.update(task, advance=1)
-
-                click.echo("\nInserting image records into the database...")
-                cursor.executemany(
-                    'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
-                    images_to_insert
-                )
-                conn.commit()
-                click.secho(f"Successfully committed {len(images_to_insert)} records to the database.", fg="green")
-                doc.close()
-
-        except Exception as e:
-            click.secho(f"An unexpected error occurred while processing {original_filename}: {e}", fg="red", err=True)
-
-        finally:
-            if is_temp and os.path.exists(local_pdf_path):
-                os.remove(local_pdf_path)
-
-        click.secho(f"\n✅ All done! Upload complete for '{original_filename}'.", fg="green", bold=True)
+                        conn.commit()
+                    finally:
+                        conn.rollback()  # No-op after a successful commit
+                        conn.execute(f'PRAGMA wal_autocheckpoint = {DEFAULT_WAL_AUTOCHECKPOINT}')
+                        conn.close()
+                    click.echo(f"Created session: {click.style(session_id, fg='cyan')}")
+                    click.secho(f"Successfully committed {len(images_to_insert)} records to the database.", fg="green")
+
+            except Exception as e:
+                click.secho(f"An unexpected error occurred while processing {original_filename}: {e}", fg="red", err=True)
+
+            finally:
+                if is_temp and os.path.exists(local_pdf_path):
+                    os.remove(local_pdf_path)
+
+            click.secho(f"\n✅ All done! Upload complete for '{original_filename}'.", fg="green", bold=True)
 
 if __name__ == '__main__':
     cli()
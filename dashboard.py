@@ -3,115 +3,63 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_required, current_user
 from database import get_db_connection
 import os
+from collections import defaultdict
 from flask import current_app
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
-def get_session_size(session_id, user_id):
-    """Calculate the total size of files associated with a session."""
-    import os
-    from flask import current_app
+# Session ids per IN (...) list, well under SQLite's bound-parameter limit
+BATCH_DELETE_CHUNK_SIZE = 500
 
-    # Import logging
+def _safe_size(path):
+    """Size of path in bytes from a single stat, or 0 if it is missing or unreadable."""
     try:
-        from rich.console import Console
-        from rich.table import Table
-        console = Console()
-        rich_available = True
-    except ImportError:
-        # Rich not available, just use basic logging
-        console = None
-        rich_available = False
+        return os.stat(path).st_size
+    except OSError:
+        return 0
 
-    current_app.logger.info(f"Calculating size for session_id: {session_id}")
 
-    total_size = 0
-    breakdown = []
+def get_user_session_sizes(conn, sessions_rows, user_id):
+    """Total file size per session for all of a user's sessions, as {session_id: bytes}.
 
-    conn = get_db_connection()
+    Counts page and cropped images, the uploaded PDF and generated PDFs, with one query
+    per table for the whole dashboard and a single os.stat per file.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    processed_folder = current_app.config['PROCESSED_FOLDER']
+    output_folder = current_app.config['OUTPUT_FOLDER']
 
-    # Get all images associated with the session
-    images = conn.execute("""
-        SELECT filename, processed_filename, image_type
-        FROM images
-        WHERE session_id = ?
-    """, (session_id,)).fetchall()
+    files = []  # (session_id, path)
+    for session in sessions_rows:
+        if session['original_filename']:
+            files.append((session['id'], os.path.join(upload_folder, f"{session['id']}_{session['original_filename']}")))
 
-    # Add sizes of original and processed images
+    images = conn.execute("""
+        SELECT i.session_id, i.filename, i.processed_filename
+        FROM images i
+        JOIN sessions s ON s.id = i.session_id
+        WHERE s.user_id = ?
+    """, (user_id,)).fetchall()
     for image in images:
-        # Add original file size (in upload folder)
         if image['filename']:
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image['filename'])
-            if os.path.exists(file_path):
-                size = os.path.getsize(file_path)
-                total_size += size
-                current_app.logger.info(f"  Original image {image['filename']}: {size} bytes")
-                breakdown.append(("Original Image", image['filename'], size))
-            else:
-                current_app.logger.info(f"  Original image file not found: {file_path}")
-
-        # Add processed/cropped image size (in processed folder)
+            files.append((image['session_id'], os.path.join(upload_folder, image['filename'])))
         if image['processed_filename']:
-            file_path = os.path.join(current_app.config['PROCESSED_FOLDER'], image['processed_filename'])
-            if os.path.exists(file_path):
-                size = os.path.getsize(file_path)
-                total_size += size
-                current_app.logger.info(f"  Processed image {image['processed_filename']}: {size} bytes")
-                breakdown.append(("Processed Image", image['processed_filename'], size))
-            else:
-                current_app.logger.info(f"  Processed image file not found: {file_path}")
-
-    # Add size of original PDF file if it exists
-    session_info = conn.execute("SELECT original_filename FROM sessions WHERE id = ?", (session_id,)).fetchone()
-    if session_info and session_info['original_filename']:
-        # Try to find the original PDF in the upload folder with the session ID prefix
-        pdf_filename = f"{session_id}_{session_info['original_filename']}"
-        pdf_path = os.path.join(current_app.config['UPLOAD_FOLDER'], pdf_filename)
-        if os.path.exists(pdf_path):
-            size = os.path.getsize(pdf_path)
-            total_size += size
-            current_app.logger.info(f"  Original PDF {pdf_filename}: {size} bytes")
-            breakdown.append(("Original PDF", pdf_filename, size))
-        else:
-            current_app.logger.info(f"  Original PDF file not found: {pdf_path}")
-
-    # Add size of any generated PDFs for this session
-    generated_pdfs = conn.execute("""
-        SELECT filename
-        FROM generated_pdfs
-        WHERE session_id = ?
-    """, (session_id,)).fetchall()
+            files.append((image['session_id'], os.path.join(processed_folder, image['processed_filename'])))
 
+    generated_pdfs = conn.execute("""
+        SELECT g.session_id, g.filename
+        FROM generated_pdfs g
+        JOIN sessions s ON s.id = g.session_id
+        WHERE s.user_id = ?
+    """, (user_id,)).fetchall()
     for pdf in generated_pdfs:
         if pdf['filename']:
-            pdf_path = os.path.join(current_app.config['OUTPUT_FOLDER'], pdf['filename'])
-            if os.path.exists(pdf_path):
-                size = os.path.getsize(pdf_path)
-                total_size += size
-                current_app.logger.info(f"  Generated PDF {pdf['filename']}: {size} bytes")
-                breakdown.append(("Generated PDF", pdf['filename'], size))
-            else:
-                current_app.logger.info(f"  Generated PDF file not found: {pdf_path}")
-
-    current_app.logger.info(f"Total size for session {session_id}: {total_size} bytes")
-
-    # Create a rich table to show breakdown if rich is available
-    if rich_available and console:
-        table = Table(title=f"Session {session_id} Size Breakdown")
-        table.add_column("File Type", style="cyan")
-        table.add_column("Filename", style="magenta")
-        table.add_column("Size (bytes)", style="green")
-
-        for file_type, filename, size in breakdown:
-            table.add_row(file_type, filename, str(size))
-
-        if breakdown:
-            console.print(table)
-        else:
-            console.print(f"[yellow]No files found for session {session_id}[/yellow]")
+            files.append((pdf['session_id'], os.path.join(output_folder, pdf['filename'])))
 
-    conn.close()
-    return total_size
+    sizes = defaultdict(int)
+    for session_id, path in files:
+        sizes[session_id] += _safe_size(path)
+    return sizes
 
 
 def format_file_size(size_bytes):
@@ -145,13 +93,15 @@ def dashboard():
         ORDER BY s.created_at DESC
     """, (current_user.id,)).fetchall()
 
+    # Calculate sizes only if requested, for all sessions at once
+    session_sizes = get_user_session_sizes(conn, sessions_rows, current_user.id) if show_size else None
+
     sessions = []
     for session in sessions_rows:
         session_dict = dict(session)
 
-        # Calculate total size for this session only if requested
         if show_size:
-            session_size = get_session_size(session_dict['id'], current_user.id)
+            session_size = session_sizes[session_dict['id']]
             session_dict['total_size'] = session_size
             session_dict['total_size_formatted'] = format_file_size(session_size)
 
@@ -172,36 +122,45 @@ def batch_delete_sessions():
 
     try:
         conn = get_db_connection()
-        for session_id in session_ids:
-            # Security Check: Ensure the session belongs to the current user
-            session_owner = conn.execute('SELECT user_id FROM sessions WHERE id = ?', (session_id,)).fetchone()
-            if not session_owner or session_owner['user_id'] != current_user.id:
-                # Silently skip or log an error, but don't delete
+        # All deletions share one write transaction instead of journaling statement by statement
+        conn.execute('BEGIN IMMEDIATE')
+        deleted_images = []
+        for start in range(0, len(session_ids), BATCH_DELETE_CHUNK_SIZE):
+            chunk = session_ids[start:start + BATCH_DELETE_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+
+            # Security Check: only sessions that belong to the current user are deleted
+            owned_ids = [row['id'] for row in conn.execute(
+                f'SELECT id FROM sessions WHERE id IN ({placeholders}) AND user_id = ?', (*chunk, current_user.id)
+            ).fetchall()]
+            for session_id in set(chunk).difference(owned_ids):
                 current_app.logger.warning(f"User {current_user.id} attempted to delete unauthorized session {session_id}.")
+            if not owned_ids:
                 continue
 
-            # Delete associated files
-            images_to_delete = conn.execute('SELECT filename, processed_filename FROM images WHERE session_id = ?', (session_id,)).fetchall()
-            for img in images_to_delete:
-                if img['filename']:
-                    try:
-                        os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], img['filename']))
-                    except OSError:
-                        pass
-                if img['processed_filename']:
-                    try:
-                        os.remove(os.path.join(current_app.config['PROCESSED_FOLDER'], img['processed_filename']))
-                    except OSError:
-                        pass
-
-            # Delete from database
-            conn.execute('DELETE FROM questions WHERE session_id = ?', (session_id,))
-            conn.execute('DELETE FROM images WHERE session_id = ?', (session_id,))
-            conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+            owned_placeholders = ','.join('?' * len(owned_ids))
+            conn.execute(f'DELETE FROM questions WHERE session_id IN ({owned_placeholders})', owned_ids)
+            deleted_images.extend(conn.execute(
+                f'DELETE FROM images WHERE session_id IN ({owned_placeholders}) RETURNING filename, processed_filename', owned_ids
+            ).fetchall())
+            conn.execute(f'DELETE FROM sessions WHERE id IN ({owned_placeholders})', owned_ids)
 
         conn.commit()
         conn.close()
 
+        # Delete associated files once the rows are gone
+        for img in deleted_images:
+            if img['filename']:
+                try:
+                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], img['filename']))
+                except OSError:
+                    pass
+            if img['processed_filename']:
+                try:
+                    os.remove(os.path.join(current_app.config['PROCESSED_FOLDER'], img['processed_filename']))
+                except OSError:
+                    pass
+
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
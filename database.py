@@ -1,10 +1,14 @@
 
 import os
+import json
 import sqlite3
 from datetime import datetime, timedelta
 from flask import current_app
 from utils import get_db_connection
 
+# Cached OCR results unused for this many days are removed by cleanup_old_data
+OCR_CACHE_MAX_IDLE_DAYS = int(os.getenv('OCR_CACHE_MAX_IDLE_DAYS', 90))
+
 def setup_database():
     """Initializes the database and creates/updates tables as needed."""
     conn = get_db_connection()
@@ -189,6 +193,50 @@ def setup_database():
     );
     """)
 
+    # Create upload_progress table so async PDF splitting status is visible to every worker process
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS upload_progress (
+        session_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        progress INTEGER DEFAULT 0,
+        total INTEGER,
+        message TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    # Create classification_jobs table so background extract-and-classify runs can be polled from any worker
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS classification_jobs (
+        job_id TEXT PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        progress INTEGER DEFAULT 0,
+        message TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    # Create user_meta table: per-user counters other workers can check, e.g. whether cached suggestions are current
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_meta (
+        user_id INTEGER PRIMARY KEY,
+        suggestions_version INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+
+    # Create ocr_cache table: NIM OCR results keyed by a hash of the exact image bytes sent.
+    # A content-hashed result never goes stale; last_used only drives eviction of unused entries.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ocr_cache (
+        hash TEXT PRIMARY KEY,
+        result TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
     # --- Migrations ---
     try:
         cursor.execute("SELECT topic_order FROM subjective_questions LIMIT 1")
@@ -321,6 +369,28 @@ def setup_database():
     except sqlite3.OperationalError:
         cursor.execute("ALTER TABLE users ADD COLUMN classifier_model TEXT DEFAULT 'gemini'")
 
+    try:
+        cursor.execute("SELECT last_used FROM ocr_cache LIMIT 1")
+    except sqlite3.OperationalError:
+        # ADD COLUMN cannot default to CURRENT_TIMESTAMP, so existing rows start from created_at
+        cursor.execute("ALTER TABLE ocr_cache ADD COLUMN last_used TIMESTAMP")
+        cursor.execute("UPDATE ocr_cache SET last_used = created_at")
+
+    # --- Indexes ---
+    # Back the sessions -> questions/images joins and per-user filters used throughout the routes
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_sessions_user ON sessions(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_questions_session ON questions(session_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_questions_image ON questions(image_id)")
+    # Per-session page lookups and MAX(image_index) resolve from one composite index
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_images_session_index ON images(session_id, image_index)")
+    # Age-based cleanup of non-persisted sessions and PDFs (cleanup_old_data, cli.py db-cleanup)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_sessions_persist_created ON sessions(persist, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_generated_pdfs_persist_created ON generated_pdfs(persist, created_at)")
+    # Eviction of OCR cache entries that have gone unused (cleanup_old_data)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_ocr_cache_last_used ON ocr_cache(last_used)")
+    # Covers the classified-session lookup in cleanup.py
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_questions_session_classified ON questions(session_id) WHERE subject IS NOT NULL AND chapter IS NOT NULL")
+
     conn.commit()
     conn.close()
 
@@ -360,6 +430,11 @@ def cleanup_old_data():
             pass
         conn.execute('DELETE FROM generated_pdfs WHERE id = ?', (pdf_id,))
 
+    conn.execute('DELETE FROM upload_progress WHERE updated_at < ?', (cutoff,))
+    conn.execute('DELETE FROM classification_jobs WHERE updated_at < ?', (cutoff,))
+    # OCR results are keyed by image content, so they are only evicted once unused for a long time
+    conn.execute("DELETE FROM ocr_cache WHERE last_used < datetime('now', ?)", (f'-{OCR_CACHE_MAX_IDLE_DAYS} days',))
+
     db_filenames = {row['filename'] for row in conn.execute('SELECT filename FROM generated_pdfs').fetchall()}
     for filename in os.listdir(current_app.config['OUTPUT_FOLDER']):
         if filename not in db_filenames:
@@ -376,6 +451,99 @@ def cleanup_old_data():
     conn.close()
     print("Cleanup finished.")
 
+def set_upload_progress(session_id, status, progress=0, total=None, message=None):
+    """Records the async processing status of a session, replacing any previous entry."""
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO upload_progress (session_id, status, progress, total, message, updated_at) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+            (session_id, status, progress, total, message)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def fetch_upload_progress(session_id):
+    """Returns the stored processing status for a session as a dict, or None if there is none."""
+    conn = get_db_connection()
+    row = conn.execute('SELECT status, progress, total, message FROM upload_progress WHERE session_id = ?', (session_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {key: row[key] for key in row.keys() if row[key] is not None}
+
+def create_classification_job(job_id, session_id, user_id):
+    """Registers a queued extract-and-classify job for a session."""
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "INSERT INTO classification_jobs (job_id, session_id, user_id, status, message) VALUES (?, ?, ?, 'queued', 'Queued')",
+            (job_id, session_id, user_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def set_classification_job(job_id, status, progress=0, message=None):
+    """Updates the status of an extract-and-classify job."""
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            'UPDATE classification_jobs SET status = ?, progress = ?, message = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?',
+            (status, progress, message, job_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def fetch_classification_job(job_id, user_id):
+    """Returns a user's extract-and-classify job status as a dict, or None if there is none."""
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT session_id, status, progress, message FROM classification_jobs WHERE job_id = ? AND user_id = ?',
+        (job_id, user_id)
+    ).fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {key: row[key] for key in row.keys() if row[key] is not None}
+
+def fetch_ocr_cache(hashes):
+    """Returns {hash: ocr_result} for the given image hashes that have a cached OCR result, marking hits as used."""
+    if not hashes:
+        return {}
+    conn = get_db_connection()
+    try:
+        placeholders = ','.join('?' * len(hashes))
+        rows = conn.execute(f'SELECT hash, result FROM ocr_cache WHERE hash IN ({placeholders})', list(hashes)).fetchall()
+        if rows:
+            # Refreshed at most once a day per entry, so repeated hits don't turn every read into a write
+            hit_placeholders = ','.join('?' * len(rows))
+            conn.execute(
+                f"UPDATE ocr_cache SET last_used = CURRENT_TIMESTAMP "
+                f"WHERE hash IN ({hit_placeholders}) AND last_used < datetime('now', '-1 day')",
+                [row['hash'] for row in rows]
+            )
+            conn.commit()
+    finally:
+        conn.close()
+    return {row['hash']: json.loads(row['result']) for row in rows}
+
+def store_ocr_cache(results):
+    """Caches OCR results given as (hash, ocr_result) pairs; existing entries are kept."""
+    if not results:
+        return
+    conn = get_db_connection()
+    try:
+        conn.executemany(
+            # last_used is set explicitly: a migrated table's column has no default
+            'INSERT OR IGNORE INTO ocr_cache (hash, result, last_used) VALUES (?, ?, CURRENT_TIMESTAMP)',
+            [(image_hash, json.dumps(ocr_result)) for image_hash, ocr_result in results]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
 def get_folder_tree(user_id=None):
     conn = get_db_connection()
     if user_id:
@@ -451,3 +619,16 @@ def get_all_descendant_folder_ids(conn, folder_id, user_id=None):
     for child_id in folder_ids:
         folder_ids.extend(get_all_descendant_folder_ids(conn, child_id, user_id))
     return folder_ids
+
+def fetch_suggestions_version(conn, user_id):
+    """Returns the user's classified-question suggestions version (0 if never bumped)."""
+    row = conn.execute('SELECT suggestions_version FROM user_meta WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+def bump_suggestions_version(conn, user_id):
+    """Marks the user's chapter/tag suggestions as changed; call inside the transaction that changed them."""
+    conn.execute(
+        'INSERT INTO user_meta (user_id, suggestions_version) VALUES (?, 1) '
+        'ON CONFLICT(user_id) DO UPDATE SET suggestions_version = suggestions_version + 1',
+        (user_id,)
+    )
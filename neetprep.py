@@ -128,9 +128,8 @@ def sync_neetprep_data():
     force_sync = data.get('force', False)
     print(f"NeetPrep sync started by user {current_user.id}. Force sync: {force_sync}")
 
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
-        
         if force_sync:
             print("Force sync enabled. Clearing processed attempts and questions tables.")
             conn.execute('DELETE FROM neetprep_processed_attempts')
@@ -157,7 +156,6 @@ def sync_neetprep_data():
         new_attempts = [aid for aid in all_attempt_ids if aid not in processed_attempt_ids]
         print(f"Found {len(new_attempts)} new attempts to process.")
         if not new_attempts:
-            conn.close()
             return jsonify({'status': 'No new test attempts to sync. Everything is up-to-date.'}), 200
 
         incorrect_question_ids = set()
@@ -178,7 +176,6 @@ def sync_neetprep_data():
             for attempt_id in new_attempts:
                 conn.execute('INSERT INTO neetprep_processed_attempts (attempt_id) VALUES (?)', (attempt_id,))
             conn.commit()
-            conn.close()
             return jsonify({'status': 'Sync complete. No new questions found, but attempts log updated.'}), 200
 
         questions_to_insert = []
@@ -211,15 +208,14 @@ def sync_neetprep_data():
             conn.execute('INSERT INTO neetprep_processed_attempts (attempt_id) VALUES (?)', (attempt_id,))
 
         conn.commit()
-        conn.close()
 
         return jsonify({'status': f'Sync complete. Added {len(questions_to_insert)} new questions.'}), 200
 
     except Exception as e:
         current_app.logger.error(f"Error during NeetPrep sync: {repr(e)}")
-        if 'conn' in locals() and conn:
-            conn.close()
         return jsonify({'error': f"A critical error occurred during sync: {repr(e)}"}), 500
+    finally:
+        conn.close()
 
 @neetprep_bp.route('/neetprep/classify', methods=['POST'])
 @login_required
@@ -3,7 +3,7 @@ import json
 import requests
 import sys
 from typing import List, Optional, Dict, Any
-from api_key_manager import get_api_key_manager
+from api_key_manager import get_api_key_manager, post_with_retry
 
 def classify_questions_with_nova(questions: List[str], start_index: int = 0) -> Optional[Dict[Any, Any]]:
     """
@@ -246,7 +246,7 @@ Output ONLY the JSON response, nothing else.
     print(f"Sending request to Nova API. Body: {json.dumps(request_body, indent=2)}")  # Full logging enabled
 
     try:
-        response = requests.post(url, headers=headers, json=request_body, timeout=300)
+        response = post_with_retry(url, headers=headers, json=request_body, timeout=300)
         response.raise_for_status()
 
         print(f"Received raw response from Nova: {response.text}")  # Full logging enabled
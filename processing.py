@@ -4,15 +4,29 @@ import base64
 import io
 import re
 import json
+import functools
 import requests
 import cv2
 import numpy as np
 from PIL import Image
 from flask import current_app
-from api_key_manager import get_api_key_manager
+from api_key_manager import get_api_key_manager, post_with_retry, RateLimiter
+
+# Make sure OpenCV's warps and color conversions use every core
+cv2.setNumThreads(os.cpu_count() or 1)
 
 # --- NVIDIA NIM Configuration ---
 NIM_API_URL = "https://ai.api.nvidia.com/v1/cv/nvidia/nemoretriever-ocr-v1"
+# Shared across threads so concurrent OCR workers stay under NIM's request quota
+_nim_rate_limiter = RateLimiter(float(os.getenv('OCR_RPS', 5)))
+# Upper bound on in-flight OCR requests for callers fanning images out over a thread pool.
+# OCR_RPS sets the throughput; this only needs to be high enough to cover NIM's latency at that rate.
+NIM_MAX_CONCURRENCY = int(os.getenv('OCR_MAX_WORKERS', 16))
+# Images sent per NIM request by call_nim_ocr_api_batch callers; 1 sends them one at a time
+NIM_BATCH_SIZE = max(1, int(os.getenv('NIM_BATCH_SIZE', 8)))
+# NIM's inline limit on base64 image data: per image, and the total a batched request may carry
+NIM_MAX_IMAGE_B64 = 180000
+NIM_MAX_PAYLOAD_B64 = max(NIM_MAX_IMAGE_B64, int(os.getenv('NIM_MAX_PAYLOAD_B64', NIM_MAX_IMAGE_B64)))
 
 def resize_image_if_needed(image_path: str) -> bytes:
     """Resizes an image to a maximum of 500x500 pixels and returns bytes."""
@@ -44,16 +58,16 @@ def resize_image_if_needed(image_path: str) -> bytes:
         image_bytes = img_byte_arr.getvalue()
         
         base64_size = len(base64.b64encode(image_bytes).decode('utf-8'))
-        if base64_size > 180000:
-            quality = max(50, int(85 * (180000 / base64_size)))
+        if base64_size > NIM_MAX_IMAGE_B64:
+            quality = max(50, int(85 * (NIM_MAX_IMAGE_B64 / base64_size)))
             img_byte_arr = io.BytesIO()
             resized_image.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
             image_bytes = img_byte_arr.getvalue()
             
         return image_bytes
 
-def call_nim_ocr_api(image_bytes: bytes):
-    """Calls the NVIDIA NIM API to perform OCR on an image."""
+def _post_nim_ocr(images: list):
+    """Sends one or more images to the NVIDIA NIM OCR API in a single request and returns the raw result."""
     # Get API key from the manager
     manager = get_api_key_manager()
     api_key, key_index = manager.get_key('nvidia')
@@ -67,25 +81,23 @@ def call_nim_ocr_api(image_bytes: bytes):
         "Content-Type": "application/json",
     }
         
-    base64_encoded_data = base64.b64encode(image_bytes)
-    base64_string = base64_encoded_data.decode('utf-8')
-    
-    if len(base64_string) > 180000:
-        raise Exception("Image too large. To upload larger images, use the assets API.")
-    
-    image_url = f"data:image/png;base64,{base64_string}"
+    inputs = []
+    for image_bytes in images:
+        base64_string = base64.b64encode(image_bytes).decode('utf-8')
+        
+        if len(base64_string) > NIM_MAX_IMAGE_B64:
+            raise Exception("Image too large. To upload larger images, use the assets API.")
+        
+        inputs.append({
+            "type": "image_url",
+            "url": f"data:image/png;base64,{base64_string}"
+        })
     
-    payload = {
-        "input": [
-            {
-                "type": "image_url",
-                "url": image_url
-            }
-        ]
-    }
+    payload = {"input": inputs}
     
     try:
-        response = requests.post(NIM_API_URL, headers=NIM_HEADERS, json=payload, timeout=300)
+        _nim_rate_limiter.acquire()
+        response = post_with_retry(NIM_API_URL, headers=NIM_HEADERS, json=payload, timeout=300)
         response.raise_for_status()
         result = response.json()
         manager.mark_success('nvidia', key_index)
@@ -100,6 +112,56 @@ def call_nim_ocr_api(image_bytes: bytes):
                 error_detail = e.response.text
         raise Exception(f"NIM API Error: {error_detail}")
 
+def call_nim_ocr_api(image_bytes: bytes):
+    """Calls the NVIDIA NIM API to perform OCR on an image."""
+    return _post_nim_ocr([image_bytes])
+
+def _nim_ocr_request(images: list) -> list:
+    """One NIM request for images; returns one call_nim_ocr_api()-shaped result per image."""
+    result = _post_nim_ocr(images)
+    data = result.get('data') or []
+    if len(data) != len(images):
+        raise Exception(f"NIM API Error: expected {len(images)} OCR results, got {len(data)}")
+    return [{'data': [entry]} for entry in data]
+
+def _nim_payload_chunks(images: list):
+    """Groups image indexes into requests of at most NIM_BATCH_SIZE images and NIM_MAX_PAYLOAD_B64 base64 chars."""
+    chunk, payload_size = [], 0
+    for index, image_bytes in enumerate(images):
+        b64_size = 4 * ((len(image_bytes) + 2) // 3)
+        if chunk and (len(chunk) >= NIM_BATCH_SIZE or payload_size + b64_size > NIM_MAX_PAYLOAD_B64):
+            yield chunk
+            chunk, payload_size = [], 0
+        chunk.append(index)
+        payload_size += b64_size
+    if chunk:
+        yield chunk
+
+def call_nim_ocr_api_batch(images: list) -> list:
+    """
+    OCRs several images with as few NIM requests as the payload limit allows. Returns one result
+    per image, each shaped like a call_nim_ocr_api() response ({'data': [...]}) so callers can parse
+    them the same way, or None for an image NIM could not OCR.
+    """
+    results = [None] * len(images)
+    for indexes in _nim_payload_chunks(images):
+        try:
+            for index, ocr_result in zip(indexes, _nim_ocr_request([images[i] for i in indexes])):
+                results[index] = ocr_result
+            continue
+        except Exception as e:
+            if len(indexes) == 1:
+                print(f"NIM OCR failed for an image: {e}")
+                continue
+            print(f"NIM OCR batch of {len(indexes)} images failed, retrying them one at a time: {e}")
+        # One oversized or unreadable crop must not cost its neighbours their OCR results
+        for index in indexes:
+            try:
+                results[index] = _nim_ocr_request([images[index]])[0]
+            except Exception as e:
+                print(f"NIM OCR failed for an image: {e}")
+    return results
+
 def extract_question_number_from_ocr_result(ocr_result: dict) -> str:
     """Extracts the question number from the OCR result."""
     try:
@@ -125,22 +187,27 @@ def extract_question_number_from_ocr_result(ocr_result: dict) -> str:
     except (KeyError, IndexError, TypeError):
         return ""
 
-def crop_image_perspective(image_path, points):
-    if len(points) < 4: return cv2.imread(image_path)
-    img = cv2.imread(image_path)
+def crop_image_perspective(image_source, points):
+    """Crops a quadrilateral from an image path or an already decoded BGR ndarray."""
+    img = image_source if isinstance(image_source, np.ndarray) else cv2.imread(image_source)
+    if len(points) < 4: return img
     if img is None: raise ValueError("Could not read the image file.")
     height, width = img.shape[:2]
-    def clamp(val): return max(0.0, min(1.0, val))
-    src_points = np.array([[clamp(p.get('x', 0.0)) * width, clamp(p.get('y', 0.0)) * height] for p in points[:4]], dtype=np.float32)
-    (tl, tr, br, bl) = src_points
-    width_top, width_bottom = np.linalg.norm(tr - tl), np.linalg.norm(br - bl)
-    max_width = int(max(width_top, width_bottom))
-    height_right, height_left = np.linalg.norm(tr - br), np.linalg.norm(tl - bl)
-    max_height = int(max(height_right, height_left))
+    # Points are normalized (tl, tr, br, bl); clamp and scale them to pixels in one step
+    src_points = np.array([[p.get('x', 0.0), p.get('y', 0.0)] for p in points[:4]], dtype=np.float32)
+    src_points = np.clip(src_points, 0.0, 1.0) * np.array([width, height], dtype=np.float32)
+    # Top/bottom edge lengths and right/left edge lengths
+    max_width = int(np.linalg.norm(src_points[[1, 2]] - src_points[[0, 3]], axis=1).max())
+    max_height = int(np.linalg.norm(src_points[[1, 0]] - src_points[[2, 3]], axis=1).max())
     if max_width == 0 or max_height == 0: return img
+    # Warp only the axis-aligned bounding box of the quad (plus a pixel of margin for
+    # interpolation) instead of the full page; the crop is usually a small part of it
+    x0, y0 = np.maximum(np.floor(src_points.min(axis=0)).astype(int) - 1, 0)
+    x1, y1 = np.ceil(src_points.max(axis=0)).astype(int) + 2
+    sub_img = img[y0:y1, x0:x1]
     dst_points = np.array([[0, 0], [max_width - 1, 0], [max_width - 1, max_height - 1], [0, max_height - 1]], dtype=np.float32)
-    matrix = cv2.getPerspectiveTransform(src_points, dst_points)
-    return cv2.warpPerspective(img, matrix, (max_width, max_height))
+    matrix = cv2.getPerspectiveTransform(src_points - np.array([x0, y0], dtype=np.float32), dst_points)
+    return cv2.warpPerspective(sub_img, matrix, (max_width, max_height))
 
 def create_pdf_from_full_images(image_paths, output_filename, resolution=300.0):
     """
@@ -182,6 +249,19 @@ def create_pdf_from_full_images(image_paths, output_filename, resolution=300.0):
         print(f"Error saving final PDF: {e}")
         return False
 
+# Linear RGB -> XYZ matrix with the D65 white point (0.95047, 1.0, 1.08883) folded into each row
+_RGB_TO_SCALED_XYZ = (np.array([
+    [0.4124, 0.3576, 0.1805],
+    [0.2126, 0.7152, 0.0722],
+    [0.0193, 0.1192, 0.9505],
+], dtype=np.float32) / np.array([[0.95047], [1.00000], [1.08883]], dtype=np.float32))
+
+@functools.lru_cache(maxsize=1)
+def _srgb_to_linear_lut():
+    """Returns a 256-entry float32 table mapping 8-bit sRGB values to linear RGB."""
+    norm = np.arange(256, dtype=np.float32) / 255.0
+    return np.where(norm > 0.04045, np.power((norm + 0.055) / 1.055, 2.4), norm / 12.92).astype(np.float32)
+
 def remove_color_from_image(image_path, target_colors, threshold, bg_mode, region_box=None):
     """
     Removes specific colors from an image using CIELAB Delta E distance.
@@ -205,27 +285,21 @@ def remove_color_from_image(image_path, target_colors, threshold, bg_mode, regio
     # (Frontend JS might be using 0-255 raw, let's verify frontend code provided earlier)
     # Frontend code: r = rgb[0] / 255 ...
     # Yes, frontend normalizes.
-    rgb_norm = img_rgb.astype(np.float32) / 255.0
-    
     # 2. RGB to XYZ (Vectorized)
     # Formula matches JS: r = (r > 0.04045) ? ...
-    mask_linear = rgb_norm > 0.04045
-    rgb_linear = np.where(mask_linear, np.power((rgb_norm + 0.055) / 1.055, 2.4), rgb_norm / 12.92)
-    
-    R, G, B = rgb_linear[:,:,0], rgb_linear[:,:,1], rgb_linear[:,:,2]
-    
-    X = R * 0.4124 + G * 0.3576 + B * 0.1805
-    Y = R * 0.2126 + G * 0.7152 + B * 0.0722
-    Z = R * 0.0193 + G * 0.1192 + B * 0.9505
+    if img_rgb.dtype == np.uint8:
+        # 8-bit input only has 256 possible values, so linearize with a table lookup
+        rgb_linear = _srgb_to_linear_lut()[img_rgb]
+    else:
+        rgb_norm = img_rgb.astype(np.float32) / 255.0
+        mask_linear = rgb_norm > 0.04045
+        rgb_linear = np.where(mask_linear, np.power((rgb_norm + 0.055) / 1.055, 2.4), rgb_norm / 12.92)
     
-    # Scale XYZ
-    X /= 0.95047
-    Y /= 1.00000
-    Z /= 1.08883
+    # RGB -> XYZ and the white-point scaling fused into one 3x3 matrix product
+    xyz_stack = rgb_linear @ _RGB_TO_SCALED_XYZ.T
     
     # 3. XYZ to Lab
     # Formula: x = (x > 0.008856) ? ...
-    xyz_stack = np.stack([X, Y, Z], axis=-1)
     mask_xyz = xyz_stack > 0.008856
     f_xyz = np.where(mask_xyz, np.power(xyz_stack, 1/3), (7.787 * xyz_stack) + 16/116)
     
@@ -8,6 +8,8 @@ import io
 import base64
 import json
 
+from api_key_manager import post_with_retry
+
 # --- Configuration ---
 # API endpoints should remain constant
 INVOKE_URL_OCR = "https://ai.api.nvidia.com/v1/cv/nvidia/nemoretriever-ocr-v1"
@@ -54,7 +56,7 @@ def _detect_pictures_with_parser(image_to_process: Image.Image, api_key: str):
         "max_tokens": 2048,
     }
 
-    response = requests.post(INVOKE_URL_PARSER, headers=headers, json=payload, timeout=120)
+    response = post_with_retry(INVOKE_URL_PARSER, headers=headers, json=payload, timeout=120)
     response.raise_for_status()
     response_json = response.json()
     
@@ -79,7 +81,7 @@ def _redact_text_in_image(input_image: Image.Image, api_key: str):
     
     payload = {"input": [{"type": "image_url", "url": f"data:image/png;base64,{image_b64}"}]}
     try:
-        response = requests.post(INVOKE_URL_OCR, headers=headers, json=payload, timeout=60)
+        response = post_with_retry(INVOKE_URL_OCR, headers=headers, json=payload, timeout=60)
         response.raise_for_status()
         response_json = response.json()
     except requests.exceptions.RequestException: return input_image
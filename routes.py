@@ -7,6 +7,7 @@ import zipfile
 import threading
 import copy
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from flask import Blueprint, render_template, request, jsonify, current_app, url_for, send_from_directory, send_file, redirect
 from flask_login import login_required, current_user
@@ -18,10 +19,11 @@ import requests
 import cv2
 import numpy as np
 
-from database import get_folder_tree, get_all_descendant_folder_ids
+from database import get_folder_tree, get_all_descendant_folder_ids, set_upload_progress, fetch_upload_progress
 from processing import (
     resize_image_if_needed,
     call_nim_ocr_api,
+    NIM_MAX_CONCURRENCY,
     extract_question_number_from_ocr_result,
     crop_image_perspective,
     create_pdf_from_full_images,
@@ -29,20 +31,17 @@ from processing import (
 )
 
 from strings import *
-from utils import get_db_connection, create_a4_pdf_from_images
+from utils import get_db_connection, create_a4_pdf_from_images, stream_response_to_file, PAGE_JPEG_QUALITY
 from redact import redact_pictures_in_image
 from resize import expand_pdf_for_notes
 
-# Global dictionary to store async processing status
-# Key: session_id, Value: {'status': 'processing'|'completed'|'error', 'progress': int, 'total': int, 'message': str}
-upload_progress = {}
-
 main_bp = Blueprint('main', __name__)
 
 @main_bp.route('/upload_progress/<session_id>')
 @login_required
 def get_upload_progress(session_id):
-    status = upload_progress.get(session_id)
+    # Status lives in the DB so any worker can answer: {'status': 'processing'|'completed'|'error', 'progress', 'total', 'message'}
+    status = fetch_upload_progress(session_id)
     if not status:
         # Check if session exists in DB (maybe it finished and server restarted, or we missed it)
         conn = get_db_connection()
@@ -53,10 +52,12 @@ def get_upload_progress(session_id):
         return jsonify({'error': 'Session not found or processing not started'}), 404
     return jsonify(status)
 
-def process_pdf_background(session_id, user_id, original_filename, pdf_content, app_config):
+def process_pdf_background(session_id, user_id, pdf_path, app_config):
     """Background task to process PDF splitting."""
-    upload_progress[session_id] = {'status': 'processing', 'progress': 0, 'message': 'Starting...'}
+    set_upload_progress(session_id, 'processing', message='Starting...')
     
+    conn = None
+    doc = None
     try:
         # We need to manually create a connection since we are in a thread
         # And we can't use current_app context directly if not carefully managed, 
@@ -65,45 +66,43 @@ def process_pdf_background(session_id, user_id, original_filename, pdf_content,
         
         conn = get_db_connection() # This creates a new connection
         
-        pdf_filename = f"{session_id}_{original_filename}"
-        pdf_path = os.path.join(app_config['UPLOAD_FOLDER'], pdf_filename)
-        
-        with open(pdf_path, 'wb') as f:
-            f.write(pdf_content)
-            
         doc = fitz.open(pdf_path)
         total_pages = len(doc)
-        upload_progress[session_id]['total'] = total_pages
+        set_upload_progress(session_id, 'processing', total=total_pages, message='Starting...')
         
         # Fetch user DPI - we need to query it since current_user proxy might not work in thread
         user_row = conn.execute("SELECT dpi FROM users WHERE id = ?", (user_id,)).fetchone()
         dpi = user_row['dpi'] if user_row else 150
         
+        # Rows are inserted after the loop so this connection holds no write lock
+        # while progress updates are committed page by page
+        image_rows = []
         for i, page in enumerate(doc):
             pix = page.get_pixmap(dpi=dpi)
-            page_filename = f"{session_id}_page_{i}.png"
+            page_filename = f"{session_id}_page_{i}.jpg"
             page_path = os.path.join(app_config['UPLOAD_FOLDER'], page_filename)
-            pix.save(page_path)
+            pix.save(page_path, jpg_quality=PAGE_JPEG_QUALITY)
             
-            conn.execute(
-                'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
-                (session_id, i, page_filename, f"Page {i+1}", 'original')
-            )
+            image_rows.append((session_id, i, page_filename, f"Page {i+1}", 'original'))
             
             # Update progress
             progress = int(((i + 1) / total_pages) * 100)
-            upload_progress[session_id].update({'progress': progress, 'message': f'Processed page {i+1}/{total_pages}'})
+            set_upload_progress(session_id, 'processing', progress, total_pages, f'Processed page {i+1}/{total_pages}')
             
+        conn.executemany(
+            'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
+            image_rows
+        )
         conn.commit()
-        conn.close()
-        doc.close()
         
-        upload_progress[session_id] = {'status': 'completed', 'progress': 100, 'message': 'Done'}
+        set_upload_progress(session_id, 'completed', 100, total_pages, 'Done')
         
     except Exception as e:
         print(f"Async processing error: {e}")
-        upload_progress[session_id] = {'status': 'error', 'message': str(e)}
-        if 'conn' in locals(): conn.close()
+        set_upload_progress(session_id, 'error', message=str(e))
+    finally:
+        if doc is not None: doc.close()
+        if conn is not None: conn.close()
 
 # ... existing imports ...
 
@@ -308,9 +307,9 @@ def process_final_pdf(pdf_id):
     doc = fitz.open(pdf_path)
     for i, page in enumerate(doc):
         pix = page.get_pixmap(dpi=current_user.dpi)
-        page_filename = f"{session_id}_page_{i}.png"
+        page_filename = f"{session_id}_page_{i}.jpg"
         page_path = os.path.join(current_app.config['UPLOAD_FOLDER'], page_filename)
-        pix.save(page_path)
+        pix.save(page_path, jpg_quality=PAGE_JPEG_QUALITY)
         
         conn.execute(
             'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
@@ -393,7 +392,8 @@ def convert_google_drive_url(url):
 @login_required
 def v2_upload():
     session_id = str(uuid.uuid4())
-    pdf_content, original_filename = None, None
+    pdf_path, original_filename = None, None
+    upload_folder = current_app.config['UPLOAD_FOLDER']
 
     try:
         # Case 1: Direct file upload
@@ -401,7 +401,9 @@ def v2_upload():
             file = request.files['pdf']
             if file and file.filename.lower().endswith('.pdf'):
                 original_filename = secure_filename(file.filename)
-                pdf_content = file.read()
+                # Werkzeug spools large parts to a temp file; copy it to disk in chunks
+                pdf_path = os.path.join(upload_folder, f"{session_id}_{original_filename}")
+                file.save(pdf_path)
             else:
                 return jsonify({'error': 'Invalid file type, please upload a PDF'}), 400
 
@@ -412,7 +414,7 @@ def v2_upload():
             # Handle Google Drive URLs
             pdf_url = convert_google_drive_url(pdf_url)
             
-            response = requests.get(pdf_url, allow_redirects=True)
+            response = requests.get(pdf_url, allow_redirects=True, stream=True)
             response.raise_for_status()
             
             # Try to get filename from Content-Disposition header
@@ -429,7 +431,8 @@ def v2_upload():
             if not original_filename or not original_filename.lower().endswith('.pdf'):
                 original_filename = 'downloaded_document.pdf'
                 
-            pdf_content = response.content
+            pdf_path = os.path.join(upload_folder, f"{session_id}_{secure_filename(original_filename)}")
+            stream_response_to_file(response, pdf_path)
 
         # Case 3: cURL command upload
         elif 'curl_command' in request.form and request.form['curl_command']:
@@ -442,22 +445,25 @@ def v2_upload():
             # Handle Google Drive URLs in cURL too (though unlikely if cURL is used correctly)
             url = convert_google_drive_url(url)
             
-            response = requests.get(url, allow_redirects=True)
+            response = requests.get(url, allow_redirects=True, stream=True)
             response.raise_for_status()
             original_filename = filename
-            pdf_content = response.content
+            pdf_path = os.path.join(upload_folder, f"{session_id}_{secure_filename(original_filename)}")
+            stream_response_to_file(response, pdf_path)
 
         else:
             return jsonify({'error': 'No PDF file, URL, or cURL command provided'}), 400
 
-        if not pdf_content or not original_filename:
+        if not pdf_path or not original_filename or not os.path.getsize(pdf_path):
             return jsonify({'error': 'Failed to retrieve PDF content or filename'}), 500
 
         session_type = request.form.get('type', 'standard')
         conn = get_db_connection()
-        conn.execute('INSERT INTO sessions (id, original_filename, name, user_id, session_type) VALUES (?, ?, ?, ?, ?)', (session_id, original_filename, original_filename, current_user.id, session_type))
-        conn.commit() # Commit session creation first
-        conn.close()
+        try:
+            conn.execute('INSERT INTO sessions (id, original_filename, name, user_id, session_type) VALUES (?, ?, ?, ?, ?)', (session_id, original_filename, original_filename, current_user.id, session_type))
+            conn.commit() # Commit session creation first
+        finally:
+            conn.close()
 
         # Check for async request
         is_async = request.args.get('async') == 'true'
@@ -466,46 +472,39 @@ def v2_upload():
             # Start background thread
             # We pass app config copy to be safe
             app_config = current_app.config.copy()
-            thread = threading.Thread(target=process_pdf_background, args=(session_id, current_user.id, original_filename, pdf_content, app_config))
+            thread = threading.Thread(target=process_pdf_background, args=(session_id, current_user.id, pdf_path, app_config))
             thread.start()
             
             return jsonify({'session_id': session_id, 'status': 'processing'})
 
         # --- Sync processing logic ---
-        # Re-open connection for sync processing
+        # Re-open connection for sync processing; closing it rolls back anything left uncommitted
         conn = get_db_connection()
-        
-        pdf_filename = f"{session_id}_{original_filename}"
-        pdf_path = os.path.join(current_app.config['UPLOAD_FOLDER'], pdf_filename)
-        with open(pdf_path, 'wb') as f:
-            f.write(pdf_content)
-
-        doc = fitz.open(pdf_path)
-        page_files = []
-        for i, page in enumerate(doc):
-            pix = page.get_pixmap(dpi=current_user.dpi)
-            page_filename = f"{session_id}_page_{i}.png"
-            page_path = os.path.join(current_app.config['UPLOAD_FOLDER'], page_filename)
-            pix.save(page_path)
+        doc = None
+        try:
+            doc = fitz.open(pdf_path)
+            page_files = []
+            for i, page in enumerate(doc):
+                pix = page.get_pixmap(dpi=current_user.dpi)
+                page_filename = f"{session_id}_page_{i}.jpg"
+                page_path = os.path.join(current_app.config['UPLOAD_FOLDER'], page_filename)
+                pix.save(page_path, jpg_quality=PAGE_JPEG_QUALITY)
+                
+                conn.execute(
+                    'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
+                    (session_id, i, page_filename, f"Page {i+1}", 'original')
+                )
+                page_files.append({'filename': page_filename, 'original_name': f"Page {i+1}", 'index': i})
             
-            conn.execute(
-                'INSERT INTO images (session_id, image_index, filename, original_name, image_type) VALUES (?, ?, ?, ?, ?)',
-                (session_id, i, page_filename, f"Page {i+1}", 'original')
-            )
-            page_files.append({'filename': page_filename, 'original_name': f"Page {i+1}", 'index': i})
-        
-        conn.commit()
-        conn.close()
-        doc.close()
+            conn.commit()
+        finally:
+            if doc is not None: doc.close()
+            conn.close()
         return jsonify({'session_id': session_id, 'files': page_files})
 
     except requests.RequestException as e:
         return jsonify({'error': f"Failed to download PDF from URL: {e}"}), 500
     except Exception as e:
-        # Ensure connection is closed on error
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            conn.close()
         current_app.logger.error(f"An error occurred during v2 upload: {e}")
         return jsonify({'error': "An internal error occurred while processing the PDF."}), 500
 
@@ -669,9 +668,10 @@ def process_crop_v2():
         header, encoded = image_data_url.split(",", 1)
         image_data = base64.b64decode(encoded)
         
-        temp_filename = f"temp_filtered_{page_info['filename']}"
-        temp_path = os.path.join(current_app.config['PROCESSED_FOLDER'], temp_filename)
-        with open(temp_path, "wb") as f: f.write(image_data)
+        # Decode the filtered page once in memory instead of round-tripping through a temp file
+        page_image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        if page_image is None:
+            raise ValueError("Could not decode the submitted page image.")
 
         existing_cropped = conn.execute(
             "SELECT id, processed_filename FROM images WHERE session_id = ? AND filename = ? AND image_type = 'cropped'",
@@ -702,6 +702,8 @@ def process_crop_v2():
 
         primary_boxes = [box for box in boxes_data if not box.get('stitch_to')]
         processed_boxes = []
+        # Source pages for cross-page stitching, decoded at most once per request
+        decoded_source_pages = {}
 
         for i, primary_box in enumerate(primary_boxes):
             # Skip if this box is being consumed by another box on the same page
@@ -742,7 +744,10 @@ def process_crop_v2():
                     source_filename = source_page_db['filename']
                     source_path = os.path.join(current_app.config['UPLOAD_FOLDER'], source_filename)
                     
-                    if os.path.exists(source_path):
+                    if source_path not in decoded_source_pages and os.path.exists(source_path):
+                        decoded_source_pages[source_path] = cv2.imdecode(np.fromfile(source_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+                    if decoded_source_pages.get(source_path) is not None:
                         # Crop Source (Parent)
                         src_points = [
                             {'x': source_box['x'], 'y': source_box['y']},
@@ -751,7 +756,7 @@ def process_crop_v2():
                             {'x': source_box['x'], 'y': source_box['y'] + source_box['h']}
                         ]
                         # We use the original source file for the parent crop
-                        parent_crop = crop_image_perspective(source_path, src_points)
+                        parent_crop = crop_image_perspective(decoded_source_pages[source_path], src_points)
                         
                         # Crop Current (Child)
                         child_points = [
@@ -760,7 +765,7 @@ def process_crop_v2():
                             {'x': primary_box['x'] + primary_box['w'], 'y': primary_box['y'] + primary_box['h']},
                             {'x': primary_box['x'], 'y': primary_box['y'] + primary_box['h']}
                         ]
-                        child_crop = crop_image_perspective(temp_path, child_points)
+                        child_crop = crop_image_perspective(page_image, child_points)
                         
                         # Stitch (Parent Top, Child Bottom)
                         h1, w1 = parent_crop.shape[:2]
@@ -784,7 +789,7 @@ def process_crop_v2():
                             {'x': primary_box['x'] + primary_box['w'], 'y': primary_box['y'] + primary_box['h']},
                             {'x': primary_box['x'], 'y': primary_box['y'] + primary_box['h']}
                         ]
-                        stitched_image = crop_image_perspective(temp_path, points)
+                        stitched_image = crop_image_perspective(page_image, points)
                 else:
                      # Fallback if db lookup fails
                     current_app.logger.error(f"Source page DB record missing: session {session_id} index {source_page_index}")
@@ -794,7 +799,7 @@ def process_crop_v2():
                         {'x': primary_box['x'] + primary_box['w'], 'y': primary_box['y'] + primary_box['h']},
                         {'x': primary_box['x'], 'y': primary_box['y'] + primary_box['h']}
                     ]
-                    stitched_image = crop_image_perspective(temp_path, points)
+                    stitched_image = crop_image_perspective(page_image, points)
 
             # --- STANDARD LOCAL STITCHING OR SINGLE BOX LOGIC ---
             else:
@@ -806,7 +811,7 @@ def process_crop_v2():
                     {'x': primary_box['x'] + primary_box['w'], 'y': primary_box['y'] + primary_box['h']},
                     {'x': primary_box['x'], 'y': primary_box['y'] + primary_box['h']}
                 ]
-                primary_crop = crop_image_perspective(temp_path, points)
+                primary_crop = crop_image_perspective(page_image, points)
 
                 stitched_image = primary_crop
 
@@ -818,7 +823,7 @@ def process_crop_v2():
                         {'x': child['x'] + child['w'], 'y': child['y'] + child['h']},
                         {'x': child['x'], 'y': child['y'] + child['h']}
                     ]
-                    child_crop = crop_image_perspective(temp_path, child_points)
+                    child_crop = crop_image_perspective(page_image, child_points)
 
                     h1, w1 = primary_crop.shape[:2]
                     h2, w2 = child_crop.shape[:2]
@@ -873,7 +878,6 @@ def process_crop_v2():
         
         conn.commit()
         conn.close()
-        os.remove(temp_path)
         
         return jsonify({'success': True, 'processed_count': len(processed_boxes)})
 
@@ -1291,44 +1295,37 @@ def extract_all_question_numbers():
         if not images:
             return jsonify({'error': 'No cropped images found in session'}), 404
         
-        results = []
-        errors = []
-        
-        MAX_CONCURRENT_REQUESTS = 5
-        processed_count = 0
-        
-        for image in images:
-            if processed_count >= MAX_CONCURRENT_REQUESTS:
-                import time
-                time.sleep(1)
-                processed_count = 0
-            
+        processed_folder = current_app.config['PROCESSED_FOLDER']
+
+        def process_one(image):
+            image_id = image['id']
+            processed_filename = image['processed_filename']
             try:
-                image_id = image['id']
-                processed_filename = image['processed_filename']
-                
                 if not processed_filename:
-                    errors.append({'image_id': image_id, 'error': 'Image not processed'})
-                    continue
+                    return None, {'image_id': image_id, 'error': 'Image not processed'}
                 
-                image_path = os.path.join(current_app.config['PROCESSED_FOLDER'], processed_filename)
+                image_path = os.path.join(processed_folder, processed_filename)
                 if not os.path.exists(image_path):
-                    errors.append({'image_id': image_id, 'error': 'Image file not found on disk'})
-                    continue
+                    return None, {'image_id': image_id, 'error': 'Image file not found on disk'}
                 
                 image_bytes = resize_image_if_needed(image_path)
                 ocr_result = call_nim_ocr_api(image_bytes)
                 question_number = extract_question_number_from_ocr_result(ocr_result)
                 
-                results.append({
-                    'image_id': image_id,
-                    'question_number': question_number
-                })
-                
-                processed_count += 1
-                
+                return {'image_id': image_id, 'question_number': question_number}, None
             except Exception as e:
-                errors.append({'image_id': image['id'], 'error': str(e)})
+                return None, {'image_id': image_id, 'error': str(e)}
+
+        results = []
+        errors = []
+        
+        # The pool size caps in-flight NIM requests; call_nim_ocr_api paces them to OCR_RPS
+        with ThreadPoolExecutor(max_workers=NIM_MAX_CONCURRENCY) as executor:
+            for result, error in executor.map(process_one, images):
+                if result:
+                    results.append(result)
+                if error:
+                    errors.append(error)
         
         return jsonify({
             'success': True,
@@ -1471,25 +1468,26 @@ def generate_pdf():
     
     conn = get_db_connection()
     # Security: Check ownership of the session
-    session_owner = conn.execute('SELECT user_id FROM sessions WHERE id = ?', (session_id,)).fetchone()
-    if not session_owner or session_owner['user_id'] != current_user.id:
+    session_info = conn.execute('SELECT user_id, original_filename FROM sessions WHERE id = ?', (session_id,)).fetchone()
+    if not session_info or session_info['user_id'] != current_user.id:
         conn.close()
         return jsonify({'error': 'Unauthorized'}), 403
 
+    filter_type = data.get('filter_type', 'all')
+
+    # Filter by status in SQL so non-matching rows are never materialized
     query = """
         SELECT q.*, i.filename, i.processed_filename FROM questions q 
         JOIN images i ON q.image_id = i.id
-        WHERE q.session_id = ? ORDER BY i.id
+        WHERE q.session_id = ? AND (? = 'all' OR q.status = ?) ORDER BY i.id
     """
-    all_questions = [dict(row) for row in conn.execute(query, (session_id,)).fetchall()]
+    filtered_questions = [dict(row) for row in conn.execute(query, (session_id, filter_type, filter_type)).fetchall()]
     
+    # Miscellaneous questions come from the request body, so they are filtered here
     miscellaneous_questions = data.get('miscellaneous_questions', [])
-    all_questions.extend(miscellaneous_questions)
-
-    filter_type = data.get('filter_type', 'all')
-    filtered_questions = [
-        q for q in all_questions if filter_type == 'all' or q['status'] == filter_type
-    ]
+    filtered_questions.extend(
+        q for q in miscellaneous_questions if filter_type == 'all' or q['status'] == filter_type
+    )
 
     if not filtered_questions:
         conn.close()
@@ -1520,16 +1518,15 @@ def generate_pdf():
     font_size_scale = float(data.get('font_size_scale', 1.0))
 
     if create_a4_pdf_from_images(filtered_questions, current_app.config['PROCESSED_FOLDER'], pdf_filename, images_per_page, current_app.config['OUTPUT_FOLDER'], orientation, grid_rows, grid_cols, practice_mode, font_size_scale=font_size_scale):
-        session_info = conn.execute('SELECT original_filename FROM sessions WHERE id = ?', (session_id,)).fetchone()
-        source_filename = session_info['original_filename'] if session_info else 'Unknown'
+        source_filename = session_info['original_filename'] or 'Unknown'
         
-        conn.execute(
-            'INSERT INTO generated_pdfs (session_id, filename, subject, tags, notes, source_filename, user_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        pdf_id = conn.execute(
+            'INSERT INTO generated_pdfs (session_id, filename, subject, tags, notes, source_filename, user_id) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id',
             (session_id, pdf_filename, data.get('subject'), data.get('tags'), data.get('notes'), source_filename, current_user.id)
-        )
+        ).fetchone()['id']
         conn.commit()
         conn.close()
-        return jsonify({'success': True, 'pdf_filename': pdf_filename})
+        return jsonify({'success': True, 'pdf_filename': pdf_filename, 'pdf_id': pdf_id})
     else:
         conn.close()
         return jsonify({'error': 'PDF generation failed'}), 500
@@ -2033,15 +2030,15 @@ def merge_pdfs():
     pdf_ids = data.get('pdf_ids', [])
     if len(pdf_ids) < 2: return jsonify({'error': 'Please select at least two PDFs to merge.'}), 400
 
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         safe_pdf_ids = [int(pid) for pid in pdf_ids]
         placeholders = ', '.join('?' * len(safe_pdf_ids))
         query = f"SELECT filename FROM generated_pdfs WHERE id IN ({placeholders}) AND user_id = ?"
         pdfs_to_merge = conn.execute(query, (*safe_pdf_ids, current_user.id)).fetchall()
 
         if len(pdfs_to_merge) != len(safe_pdf_ids):
-             conn.close(); return jsonify({'error': 'One or more selected PDFs not found or are unauthorized.'}), 404
+             return jsonify({'error': 'One or more selected PDFs not found or are unauthorized.'}), 404
 
         merged_doc = fitz.open()
         source_filenames = []
@@ -2069,13 +2066,13 @@ def merge_pdfs():
             (session_id, new_filename, subject, 'merged', notes, ", ".join(source_filenames), current_user.id)
         )
         conn.commit()
-        conn.close()
         return jsonify({'success': True, 'new_filename': new_filename})
 
     except Exception as e:
-        if 'conn' in locals() and conn: conn.close()
         print(f"Error merging PDFs: {e}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
 
 @main_bp.route('/upload_final_pdf')
 @login_required
@@ -9,12 +9,15 @@ import re # Import the regular expression module
 
 subjective_bp = Blueprint('subjective', __name__)
 
+# Compiled once; natural_sort_key runs once per question in every sort
+_DIGIT_RUN_RE = re.compile(r'([0-9]+)')
+
 # Helper function for natural sorting
 def natural_sort_key(s):
     if s is None:
         return (0, "") # Treat None as 0 and empty string for comparison
     return [int(text) if text.isdigit() else text.lower()
-            for text in re.split('([0-9]+)', str(s))]
+            for text in _DIGIT_RUN_RE.split(str(s))]
 
 @subjective_bp.route('/subjective_generator', methods=['GET'])
 @login_required
@@ -3,26 +3,159 @@ import math
 import base64
 import io
 import sqlite3
+import queue
+import functools
+import itertools
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image, ImageDraw, ImageFont
+import fitz  # PyMuPDF
 
 DATABASE = 'database.db'
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
+# Report canvas size in pixels at BASE_DPI and the resolution it is embedded at in the PDF
+BASE_DPI = 600
+A4_WIDTH_PX, A4_HEIGHT_PX = 4960, 7016
+PDF_RESOLUTION = 900.0
+# Rasterization dpi and JPEG quality for report pages; 300 dpi is plenty for printed questions
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', 300))
+PDF_JPEG_QUALITY = int(os.getenv('PDF_JPEG_QUALITY', 85))
+# Page-render processes shared by all report requests in this server process
+PDF_RENDER_WORKERS = max(1, int(os.getenv('PDF_RENDER_WORKERS', os.cpu_count() or 1)))
+
+# Idle connections kept for reuse; get_db_connection() callers still just call close()
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+_db_pool = queue.LifoQueue()
+_wal_enabled = False
+
+def _release_connection(conn):
+    """Returns a raw connection to the pool, or closes it if the pool is full or it is unusable."""
+    try:
+        if conn.in_transaction:
+            conn.rollback()  # Same outcome as closing with uncommitted changes
+        conn.row_factory = sqlite3.Row
+    except sqlite3.Error:
+        conn.close()
+        return
+    if _db_pool.qsize() >= DB_POOL_SIZE:
+        conn.close()
+        return
+    _db_pool.put(conn)
+
+class _PooledConnection:
+    """
+    Handle to a pooled sqlite3 connection, handed out by get_db_connection().
+
+    close() detaches the handle and returns the underlying connection to the pool; the handle
+    then behaves like a closed sqlite3 connection (any use raises, a second close() is a no-op),
+    so a caller that keeps its reference can never touch a connection another request now holds.
+    """
+    __slots__ = ('_conn',)
+
+    def __init__(self, conn):
+        object.__setattr__(self, '_conn', conn)
+
+    def _live(self):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self._live(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._live(), name, value)
+
+    def __enter__(self):
+        self._live().__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._live().__exit__(*exc_info)
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        _release_connection(conn)
+
+def _open_db_connection():
+    global _wal_enabled
+    # Pooled connections move between request threads, but only one thread uses a connection at a time
+    conn = sqlite3.connect(DATABASE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    if not _wal_enabled:
+        # journal_mode is stored in the database file, so switching to WAL once per process is enough
+        conn.execute('PRAGMA journal_mode=WAL')
+        _wal_enabled = True
+    # Per-connection settings, paid once per pooled connection: with WAL, NORMAL only
+    # fsyncs at checkpoints and stays crash-safe; the page cache stays warm across requests
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
     return conn
 
+def get_db_connection():
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = _open_db_connection()
+    return _PooledConnection(conn)
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Rendered PDF pages are stored as JPEG: encoding is several times faster than PNG deflate and
+# the files are a fraction of the size, at no visible cost for cropping or OCR.
+PAGE_JPEG_QUALITY = 85
+
+def stream_response_to_file(response, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Writes a streamed requests response to path in large chunks without holding the body in memory.
+    Copies straight from the raw stream so each chunk is a single read/write pair.
+    """
+    response.raw.decode_content = True
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(response.raw, f, length=chunk_size)
+
+def _ensure_font_file(font_path):
+    """Downloads the Arial TTF to font_path if it is missing. Returns True if the file is available."""
+    if os.path.exists(font_path):
+        return True
+    try:
+        import requests
+        response = requests.get("https://github.com/kavin808/arial.ttf/raw/refs/heads/master/arial.ttf", timeout=30)
+        response.raise_for_status()
+        with open(font_path, 'wb') as f: f.write(response.content)
+        return True
+    except Exception: return False
+
+@functools.lru_cache(maxsize=16)
+def _load_truetype_font(font_path, font_size):
+    # Parsed fonts are cached per (path, size); load failures raise and are not cached
+    return ImageFont.truetype(font_path, size=font_size)
+
 def get_or_download_font(font_path="arial.ttf", font_size=50):
-    if not os.path.exists(font_path):
-        try:
-            import requests
-            response = requests.get("https://github.com/kavin808/arial.ttf/raw/refs/heads/master/arial.ttf", timeout=30)
-            response.raise_for_status()
-            with open(font_path, 'wb') as f: f.write(response.content)
-        except Exception: return ImageFont.load_default()
-    try: return ImageFont.truetype(font_path, size=font_size)
+    # The font file is fetched once by preload_fonts at startup; request paths only read it from disk
+    if not os.path.exists(font_path): return ImageFont.load_default()
+    try: return _load_truetype_font(font_path, font_size)
     except IOError: return ImageFont.load_default()
 
+def preload_fonts(sizes=None, font_path="arial.ttf"):
+    """Fetches the font if missing and parses the default PDF font sizes so requests never block on either."""
+    if not _ensure_font_file(font_path):
+        print(f"Warning: could not download {font_path}; PDFs will use the default bitmap font.")
+        return
+    if sizes is None:
+        sizes = [int(round(base * PDF_RENDER_DPI / BASE_DPI)) for base in (60, 45)]
+    for font_size in sizes:
+        get_or_download_font(font_path, font_size)
+
 def draw_dashed_line(draw, p1, p2, fill, width, dash_length, gap_length):
     """Draws a dashed line between two points."""
     dx = p2[0] - p1[0]
@@ -61,166 +194,228 @@ def draw_dashed_rectangle(draw, box, fill, width, dash_length, gap_length):
     # Left
     draw_dashed_line(draw, (x0, y1), (x0, y0), fill, width, dash_length, gap_length)
 
-def create_a4_pdf_from_images(image_info, base_folder, output_filename, images_per_page, output_folder=None, orientation='portrait', grid_rows=None, grid_cols=None, practice_mode='none', return_bytes=False, font_size_scale=1.0):
-    if not image_info:
-        return False
+@functools.lru_cache(maxsize=1024)
+def _text_height(font, text):
+    # Status/answer lines repeat heavily across cells, so measure each distinct string once
+    bbox = font.getbbox(text)
+    return bbox[3] - bbox[1]
+
+def _render_pdf_page(chunk, base_folder, orientation, grid_rows, grid_cols, practice_mode, font_size_scale, dpi, jpeg_quality):
+    """Renders one A4 page of question cells and returns it as JPEG bytes.
+
+    Runs in a worker process, so it only takes picklable arguments and returns
+    an encoded buffer rather than a PIL image. Layout constants are expressed
+    at BASE_DPI and scaled to the requested dpi.
+    """
+    scale = dpi / BASE_DPI
+    def px(value):
+        return int(round(value * scale))
 
-    A4_WIDTH_PX, A4_HEIGHT_PX = 4960, 7016
-    
     # Base font sizes
     base_large = 60
     base_small = 45
     
     # Apply scaling
-    font_large = get_or_download_font(font_size=int(base_large * font_size_scale))
-    font_small = get_or_download_font(font_size=int(base_small * font_size_scale))
+    font_large = get_or_download_font(font_size=px(base_large * font_size_scale))
+    font_small = get_or_download_font(font_size=px(base_small * font_size_scale))
 
-    pages = []
-    info_chunks = [image_info[i:i + images_per_page] for i in range(0, len(image_info), images_per_page)]
+    if orientation == 'landscape':
+        page_width, page_height = px(A4_HEIGHT_PX), px(A4_WIDTH_PX)
+    else:
+        page_width, page_height = px(A4_WIDTH_PX), px(A4_HEIGHT_PX)
+    
+    page = Image.new('RGB', (page_width, page_height), 'white')
+    draw = ImageDraw.Draw(page)
+
+    is_practice_mode = practice_mode != 'none'
 
-    for chunk in info_chunks:
-        if orientation == 'landscape':
-            page_width, page_height = A4_HEIGHT_PX, A4_WIDTH_PX
+    if grid_rows and grid_cols:
+        rows, cols = grid_rows, grid_cols
+    else:
+        # Default grid calculation
+        if len(chunk) > 0:
+            cols = int(math.ceil(math.sqrt(len(chunk))))
+            rows = int(math.ceil(len(chunk) / cols))
         else:
-            page_width, page_height = A4_WIDTH_PX, A4_HEIGHT_PX
-        
-        page = Image.new('RGB', (page_width, page_height), 'white')
-        draw = ImageDraw.Draw(page)
+            rows, cols = 1, 1
+
+    margin = px(200)
+    cell_width = (page_width - 2 * margin) // cols
+    cell_height = (page_height - 2 * margin) // rows
 
-        is_practice_mode = practice_mode != 'none'
+    if is_practice_mode:
+        cell_width = (page_width - 2 * margin) // 2  # Use half the page for the question
 
-        if grid_rows and grid_cols:
-            rows, cols = grid_rows, grid_cols
+    # Cell geometry only depends on the layout, so work it out once per page
+    is_spacious = practice_mode == 'portrait_2_spacious'
+    left_align = is_practice_mode and not is_spacious
+    if is_spacious:
+        section_height = page_height // 2
+        cell_height = section_height - margin
+        cell_xs = [margin]
+        cell_ys = [margin, margin + section_height]
+        target_w = (page_width // 2) - px(250)
+        min_area = (page_width * page_height) / 12
+    else:
+        row_count = max(rows, int(math.ceil(len(chunk) / cols)))
+        cell_xs = [margin + c * cell_width for c in range(cols)]
+        cell_ys = [margin + r * cell_height for r in range(row_count)]
+        target_w = cell_width - px(40)
+    text_padding = px(20)
+
+    for i, info in enumerate(chunk):
+        if is_spacious:
+            cell_x = cell_xs[0]
+            cell_y = cell_ys[i % 2]
         else:
-            # Default grid calculation
-            if len(chunk) > 0:
-                cols = int(math.ceil(math.sqrt(len(chunk))))
-                rows = int(math.ceil(len(chunk) / cols))
-            else:
-                rows, cols = 1, 1
-
-        cell_width = (page_width - 400) // cols
-        cell_height = (page_height - 400) // rows
-
-        if is_practice_mode:
-            cell_width = (page_width - 400) // 2  # Use half the page for the question
-
-        for i, info in enumerate(chunk):
-            col = i % cols
-            row = i // cols
-
-            if practice_mode == 'portrait_2_spacious':
-                section_height = page_height // 2
-                cell_x = 200
-                cell_y = 200 + (i % 2) * section_height
-                cell_height = section_height - 200
-            else:
-                cell_x = 200 + col * cell_width
-                cell_y = 200 + row * cell_height
+            cell_x = cell_xs[i % cols]
+            cell_y = cell_ys[i // cols]
 
-            try:
-                img = None
-                if info.get('image_data'):
-                    # Handle base64 encoded image data
-                    header, encoded = info['image_data'].split(",", 1)
-                    image_data = base64.b64decode(encoded)
-                    img = Image.open(io.BytesIO(image_data)).convert("RGB")
-                elif info.get('processed_filename') or info.get('filename'):
-                    # Handle image from file path
-                    img_path = os.path.join(base_folder, info.get('processed_filename') or info.get('filename'))
-                    if os.path.exists(img_path):
-                        img = Image.open(img_path).convert("RGB")
-
-                # --- Text and Image Placement ---
-                text_x = cell_x + 20
-                if is_practice_mode and practice_mode != 'portrait_2_spacious':
-                    text_x = 200 # Align to the left for practice modes
-
-                # 1. Calculate text sizes
-                q_num_text = f"Q: {info['question_number']}"
-                info_text = f"Status: {info['status']} | Marked: {info['marked_solution']} | Correct: {info['actual_solution']}"
-                
-                q_num_bbox = draw.textbbox((0, 0), q_num_text, font=font_large)
-                info_text_bbox = draw.textbbox((0, 0), info_text, font=font_small)
+        try:
+            img = None
+            if info.get('image_data'):
+                # Handle base64 encoded image data
+                header, encoded = info['image_data'].split(",", 1)
+                image_data = base64.b64decode(encoded)
+                img = Image.open(io.BytesIO(image_data))
+            elif info.get('processed_filename') or info.get('filename'):
+                # Handle image from file path
+                img_path = os.path.join(base_folder, info.get('processed_filename') or info.get('filename'))
+                if os.path.exists(img_path):
+                    # Image.open only parses the header here; pixels are decoded after sizing
+                    img = Image.open(img_path)
+
+            # --- Text and Image Placement ---
+            text_x = margin if left_align else cell_x + px(20)  # Align to the left for practice modes
+
+            # 1. Calculate text sizes
+            q_num_text = f"Q: {info['question_number']}"
+            info_text = f"Status: {info['status']} | Marked: {info['marked_solution']} | Correct: {info['actual_solution']}"
+            
+            q_num_height = _text_height(font_large, q_num_text)
+            info_text_height = _text_height(font_small, info_text)
+            
+            total_text_height = q_num_height + info_text_height + text_padding
+
+            # 2. Draw text
+            text_y_start = cell_y + px(20)
+            draw.text((text_x, text_y_start), q_num_text, fill="black", font=font_large)
+            draw.text((text_x, text_y_start + q_num_height + text_padding), info_text, fill="black", font=font_small)
+            
+            # 3. Position and paste image below text
+            if img:
+                image_y_start = text_y_start + total_text_height + px(20)
                 
-                q_num_height = q_num_bbox[3] - q_num_bbox[1]
-                info_text_height = info_text_bbox[3] - info_text_bbox[1]
+                # Define target dimensions for the image
+                target_h = cell_height - (total_text_height + px(40))
                 
-                text_padding = 20
-                total_text_height = q_num_height + info_text_height + text_padding
+                # Calculate new dimensions while maintaining aspect ratio
+                img_ratio = img.width / img.height
+                target_ratio = target_w / target_h
+
+                if img_ratio > target_ratio:
+                    new_w = int(target_w)
+                    new_h = int(new_w / img_ratio)
+                else:
+                    new_h = int(target_h)
+                    new_w = int(new_h * img_ratio)
 
-                # 2. Draw text
-                text_y_start = cell_y + 20
-                draw.text((text_x, text_y_start), q_num_text, fill="black", font=font_large)
-                draw.text((text_x, text_y_start + q_num_height + text_padding), info_text, fill="black", font=font_small)
+                # For spacious mode, scale up if smaller than a certain area
+                if is_spacious:
+                    if new_w * new_h < min_area:
+                        scale_factor = math.sqrt(min_area / (new_w * new_h))
+                        scaled_w = int(new_w * scale_factor)
+                        scaled_h = int(new_h * scale_factor)
+                        if scaled_w <= target_w and scaled_h <= target_h:
+                            new_w, new_h = scaled_w, scaled_h
+
+                # Let libjpeg decode at a reduced scale close to the target size, then
+                # finish with a box-reduce + LANCZOS pass (same fast path as thumbnail())
+                img.draft('RGB', (new_w, new_h))
+                img = img.convert("RGB").resize((new_w, new_h), Image.Resampling.LANCZOS, reducing_gap=3.0)
                 
-                # 3. Position and paste image below text
-                if img:
-                    image_y_start = text_y_start + total_text_height + 20
-                    
-                    # Define target dimensions for the image
-                    if practice_mode == 'portrait_2_spacious':
-                        target_w = (page_width // 2) - 250
-                        available_h = cell_height - (total_text_height + 40)
-                        target_h = available_h
-                    elif is_practice_mode:
-                        target_w = cell_width - 40
-                        available_h = cell_height - (total_text_height + 40)
-                        target_h = available_h
-                    else:
-                        target_w = cell_width - 40
-                        available_h = cell_height - (total_text_height + 40)
-                        target_h = available_h
-                    
-                    # Calculate new dimensions while maintaining aspect ratio
-                    img_ratio = img.width / img.height
-                    target_ratio = target_w / target_h
-
-                    if img_ratio > target_ratio:
-                        new_w = int(target_w)
-                        new_h = int(new_w / img_ratio)
-                    else:
-                        new_h = int(target_h)
-                        new_w = int(new_h * img_ratio)
-
-                    # For spacious mode, scale up if smaller than a certain area
-                    if practice_mode == 'portrait_2_spacious':
-                        page_area = page_width * page_height
-                        if new_w * new_h < page_area / 12:
-                            scale_factor = math.sqrt((page_area / 12) / (new_w * new_h))
-                            scaled_w = int(new_w * scale_factor)
-                            scaled_h = int(new_h * scale_factor)
-                            if scaled_w <= target_w and scaled_h <= target_h:
-                                new_w, new_h = scaled_w, scaled_h
-
-                    img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                    
-                    paste_x = cell_x + 20
-                    if is_practice_mode and practice_mode != 'portrait_2_spacious':
-                        paste_x = 200
-
-                    paste_position = (paste_x, image_y_start)
-                    page.paste(img, paste_position)
-
-                    # Draw a dashed bounding box for cutting only if not in practice mode
-                    if not is_practice_mode:
-                        x0, y0 = paste_position
-                        x1, y1 = x0 + new_w, y0 + new_h
-                        draw_dashed_rectangle(draw, [x0, y0, x1, y1], fill="gray", width=3, dash_length=20, gap_length=15)
-
-            except Exception as e:
-                print(f"Error processing image for PDF: {e}")
-        
-        pages.append(page)
-
-    if pages:
-        if return_bytes:
-            pdf_bytes = io.BytesIO()
-            pages[0].save(pdf_bytes, "PDF", resolution=900.0, save_all=True, append_images=pages[1:])
-            return pdf_bytes.getvalue()
-        elif output_folder and output_filename:
-            output_path = os.path.join(output_folder, output_filename)
-            pages[0].save(output_path, "PDF", resolution=900.0, save_all=True, append_images=pages[1:])
-            return True
+                paste_position = (text_x, image_y_start)
+                page.paste(img, paste_position)
+
+                # Draw a dashed bounding box for cutting only if not in practice mode
+                if not is_practice_mode:
+                    x0, y0 = paste_position
+                    x1, y1 = x0 + new_w, y0 + new_h
+                    draw_dashed_rectangle(draw, [x0, y0, x1, y1], fill="gray", width=max(1, px(3)), dash_length=px(20), gap_length=px(15))
+
+        except Exception as e:
+            print(f"Error processing image for PDF: {e}")
+    
+    buffer = io.BytesIO()
+    page.save(buffer, "JPEG", quality=jpeg_quality)
+    return buffer.getvalue()
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    """
+    Returns the process pool for report pages, creating it on first use.
+
+    One bounded pool is shared by every request, so concurrent reports queue for the same
+    PDF_RENDER_WORKERS processes. forkserver keeps workers from being forked out of the
+    multi-threaded server, where a child could inherit a lock held by another request thread.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS,
+                                               mp_context=multiprocessing.get_context('forkserver'))
+        return _render_pool
+
+def _discard_render_pool(pool):
+    """Drops a broken pool so the next report starts a fresh one."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def create_a4_pdf_from_images(image_info, base_folder, output_filename, images_per_page, output_folder=None, orientation='portrait', grid_rows=None, grid_cols=None, practice_mode='none', return_bytes=False, font_size_scale=1.0, dpi=None, jpeg_quality=None):
+    if not image_info:
+        return False
+
+    info_chunks = [image_info[i:i + images_per_page] for i in range(0, len(image_info), images_per_page)]
+    render_args = (base_folder, orientation, grid_rows, grid_cols, practice_mode, font_size_scale, dpi or PDF_RENDER_DPI, jpeg_quality or PDF_JPEG_QUALITY)
+
+    if orientation == 'landscape':
+        page_width, page_height = A4_HEIGHT_PX, A4_WIDTH_PX
+    else:
+        page_width, page_height = A4_WIDTH_PX, A4_HEIGHT_PX
+    # PDF page size in points; fixed by the BASE_DPI canvas so the render dpi only changes sharpness
+    page_rect = fitz.Rect(0, 0, page_width * 72 / PDF_RESOLUTION, page_height * 72 / PDF_RESOLUTION)
+
+    # Pages are independent, so multi-page reports are rendered across processes.
+    # Each finished page is appended to the PDF as soon as it arrives, so only its
+    # JPEG buffer is held in memory instead of every full-size canvas.
+    doc = fitz.open()
+    try:
+        if len(info_chunks) > 1 and PDF_RENDER_WORKERS > 1:
+            pool = _get_render_pool()
+            try:
+                for page_bytes in pool.map(_render_pdf_page, info_chunks, *[itertools.repeat(arg) for arg in render_args]):
+                    doc.new_page(width=page_rect.width, height=page_rect.height).insert_image(page_rect, stream=page_bytes)
+            except BrokenProcessPool:
+                _discard_render_pool(pool)
+                raise
+        else:
+            for chunk in info_chunks:
+                page_bytes = _render_pdf_page(chunk, *render_args)
+                doc.new_page(width=page_rect.width, height=page_rect.height).insert_image(page_rect, stream=page_bytes)
+
+        if doc.page_count:
+            if return_bytes:
+                return doc.tobytes()
+            elif output_folder and output_filename:
+                output_path = os.path.join(output_folder, output_filename)
+                doc.save(output_path)
+                return True
+    finally:
+        doc.close()
     
-    return False
\ No newline at end of file
+    return False